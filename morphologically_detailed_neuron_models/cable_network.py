@@ -0,0 +1,293 @@
+import os
+import time
+import numpy as np
+import multiprocessing
+
+from dataclasses import dataclass
+
+from cable_solver import DT, V_INIT
+from cell_template import CellTemplate, ball_and_stick_cell
+
+
+SPIKE_THRESHOLD = 10    # NetCon's default threshold on the source potential [mV]
+CELLS_PER_WORKER = 500  # Cells per worker process by default, below which the overhead of a process dominates
+
+
+@dataclass
+class CableNetworkResults:
+    times: np.ndarray           # Time array                    [ms]
+    V_m: np.ndarray             # Membrane potential            [mV], of shape (n_recorded_cells, n_sites, len(times))
+    gids: np.ndarray            # The recorded cells
+    labels: list                # The recorded sites of every cell, as 'section(x)'
+    spike_gids: np.ndarray      # The cell of every spike, in the order of the spike times
+    spike_times: np.ndarray     # [ms]
+
+
+class _Partition:
+    # The cells of one worker, gids worker, worker + n_workers, ..., instantiated as a population of the template.
+    # Events are queued until their step, and spikes are detected on the source potential after every step
+
+    def __init__(self, template: CellTemplate, parameters: dict, gids: np.ndarray, dt: float, v_init: float,
+                 method: str, record: list, record_gids: np.ndarray) -> None:
+        population = template.instantiate(len(gids), {name: values[gids] for name, values in parameters.items()})
+        self.gids = gids
+        self.batch = population.initialize(dt=dt, v_init=v_init, method=method)
+        self.source = population.source
+        self.recorded_nodes = [population.node(name, x) for name, x in record]
+        self.recorded = np.flatnonzero(np.isin(gids, record_gids))
+        self.traces = [self._record()]
+        self.above = self._source_potential() >= SPIKE_THRESHOLD
+        self.events = np.empty((4, 0))
+
+    def _source_potential(self) -> np.ndarray:
+        return np.atleast_1d(self.batch.v[self.source])
+
+    def _record(self) -> np.ndarray:
+        return np.atleast_2d(self.batch.v[self.recorded_nodes].T)[self.recorded]
+
+    def advance(self, stop_step: int, events: np.ndarray) -> np.ndarray:
+        """
+        Queues the (local index, synapse, delivery time, weight) events, and simulates up to the stop step. Returns
+        the (gid, time) of every spike.
+        """
+        batch = self.batch
+        self.events = np.concatenate((self.events, events), axis=1)
+        # As NEURON's fixed step, an event is delivered at the step whose middle is past its delivery time
+        event_steps = np.ceil(self.events[2] / batch.dt - 0.5 - 1e-9)
+        spikes = []
+        while batch.step_count < stop_step:
+            due = event_steps <= batch.step_count
+            if due.any():
+                local, synapse, _, weight = self.events[:, due]
+                batch.deliver(synapse.astype(int), local.astype(int), weight)
+                self.events, event_steps = self.events[:, ~due], event_steps[~due]
+            batch.step()
+            self.traces.append(self._record())
+            above = self._source_potential() >= SPIKE_THRESHOLD
+            crossed = np.flatnonzero(above & ~self.above)
+            self.above = above
+            spikes.extend((gid, batch.t) for gid in self.gids[crossed])
+        return np.array(spikes, dtype=float).reshape(-1, 2).T
+
+    def recordings(self) -> tuple:
+        return self.gids[self.recorded], np.stack(self.traces, axis=-1)
+
+
+def _worker_error(worker: int, processes: list) -> RuntimeError:
+    # The error raised when the pipe of a worker closes, once the worker has exited and its exit code is known
+    process = processes[worker]
+    process.join(timeout=1)
+    return RuntimeError(f'Worker {worker} of {len(processes)} failed with exit code {process.exitcode}, its '
+                        f'traceback is printed above')
+
+
+def _send(connections: list, processes: list, messages: list) -> None:
+    for worker, (connection, message) in enumerate(zip(connections, messages)):
+        try:
+            connection.send(message)
+        except (BrokenPipeError, ConnectionResetError):
+            raise _worker_error(worker, processes) from None
+
+
+def _receive(connections: list, processes: list) -> list:
+    messages = []
+    for worker, connection in enumerate(connections):
+        try:
+            messages.append(connection.recv())
+        except (EOFError, ConnectionResetError):
+            raise _worker_error(worker, processes) from None
+    return messages
+
+
+def _worker(connection, *arguments) -> None:
+    # Simulates a partition in its own process, one synchronization interval per message, until None is received
+    partition = _Partition(*arguments)
+    for message in iter(connection.recv, None):
+        connection.send(partition.advance(*message))
+    connection.send(partition.recordings())
+    connection.close()
+
+
+class CableNetwork:
+    """
+    Network of compartmental cells instantiated from one template, connected from the spike source of every cell to the
+    synapses of others, as NEURON's NetCon, and driven by NetStim-like event trains. Cells are partitioned across
+    worker processes, each simulating its cells together with CellBatch. As no connection is faster than the
+    smallest delay, workers run independently for that long, and exchange their spikes only at its multiples, as
+    NEURON's ParallelContext does.
+    """
+
+    def __init__(self, n_cells: int, template: CellTemplate = None, parameters: dict = None) -> None:
+        """
+        Args:
+            n_cells (int): Number of cells, identified by their gid, from 0 to n_cells - 1
+            template (CellTemplate): Template of the cells, the ball-and-stick cell by default, which workers
+                                     instantiate their cells from
+            parameters (dict): Mechanism parameters of the cells, scalars or arrays over the gids, as in
+                               CellTemplate.instantiate
+        """
+        self.n_cells = n_cells
+        self.template = template or CellTemplate(ball_and_stick_cell)
+        self.parameters = {name: np.broadcast_to(np.asarray(values, dtype=float), (n_cells,))
+                           for name, values in (parameters or {}).items()}
+        unknown = set(self.parameters) - set(self.template.parameters)
+        assert not unknown, f'Unknown parameters {sorted(unknown)}'
+        self._connections = []
+        self._stimuli = []
+
+    def connect(self, source, target, weight=0.04, delay=5.0, synapse=0) -> None:
+        """
+        Connects the source cells to the synapse of the target cells, with the given weights [uS] and delays [ms],
+        as NetCons. Arguments are scalars or arrays, broadcast together.
+        """
+        source, target, weight, delay, synapse = np.broadcast_arrays(source, target, weight, delay, synapse)
+        assert np.all((0 <= source) & (source < self.n_cells) & (0 <= target) & (target < self.n_cells)), \
+            'Cells are between 0 and n_cells - 1'
+        assert np.all(delay > 0), 'Connections need positive delays, which bound the synchronization interval'
+        self._connections.append(np.array([source, target, weight, delay, synapse], dtype=float).reshape(5, -1))
+
+    def stimulate(self, target, start=5.0, number=1, interval=10.0, weight=0.04, delay=1.0, synapse=0) -> None:
+        """
+        Drives the synapse of the target cells with number events from start, every interval [ms], like a NetStim
+        without noise, connected with the given weight [uS] and delay [ms].
+        """
+        target, weight, delay, synapse = np.broadcast_arrays(target, weight, delay, synapse)
+        for k in range(number):
+            self._stimuli.append(np.array([target, synapse, start + k * interval + delay, weight],
+                                          dtype=float).reshape(4, -1))
+
+    @classmethod
+    def chain(cls, n_cells: int, weight: float = 0.04, delay: float = 5.0, ring: bool = False,
+              template: CellTemplate = None, parameters: dict = None) -> 'CableNetwork':
+        """
+        Returns a chain of cells, every cell connected to the next one, closed into a ring when ring is set.
+        """
+        network = cls(n_cells, template, parameters)
+        gids = np.arange(n_cells)
+        targets = (gids + 1) % n_cells if ring else gids[1:]
+        network.connect(gids[:len(targets)], targets, weight, delay)
+        return network
+
+    @property
+    def connections(self) -> np.ndarray:
+        # (source, target, weight, delay, synapse) of every connection, sorted by source
+        connections = np.concatenate(self._connections, axis=1) if self._connections else np.empty((5, 0))
+        return connections[:, np.argsort(connections[0], kind='stable')]
+
+    @property
+    def min_delay(self) -> float:
+        connections = self.connections
+        return float(connections[3].min()) if connections.shape[1] else np.inf
+
+    def simulate(self, tstop: float, n_workers: int = None, dt: float = DT, v_init: float = V_INIT,
+                 method: str = 'backward_euler', record: list = (('soma', 0.5),),
+                 record_gids: np.ndarray = None) -> CableNetworkResults:
+        """
+        Simulates the network from rest, with cell gid in partition gid % n_workers. Spikes are gathered and routed
+        to the partitions of their targets at every multiple of the smallest delay, and the recordings at the end.
+
+        Args:
+            tstop (float): Simulation time                                              [ms]
+            n_workers (int): Number of processes, by default one per CELLS_PER_WORKER cells, up to the number of CPUs,
+                             where one simulates in this process
+            dt (float): Simulation time interval                                        [ms]
+            v_init (float): Initial membrane potential of every node                    [mV]
+            method (str): Integration method, as in Cell.simulate
+            record (list): (section name, x) sites recorded in every recorded cell
+            record_gids (np.ndarray): The recorded cells, all of them by default
+
+        Returns:
+            results (CableNetworkResults): The recorded potentials and all spikes
+        """
+        n_workers = min(n_workers or max(1, min(os.cpu_count(), self.n_cells // CELLS_PER_WORKER)), self.n_cells)
+        record_gids = np.arange(self.n_cells) if record_gids is None else np.asarray(record_gids)
+        step_count = int(round(tstop / dt))
+        # The synchronization interval, in whole steps, such that no spike reaches its target within it
+        interval = int(min(self.min_delay, tstop) / dt + 1e-9)
+        assert interval >= 1, 'The smallest delay must be at least one step'
+
+        connections = self.connections
+        outgoing = np.concatenate(([0], np.cumsum(np.bincount(connections[0].astype(int), minlength=self.n_cells))))
+        stimuli = np.concatenate(self._stimuli, axis=1) if self._stimuli else np.empty((4, 0))
+        # Events as (target, synapse, delivery time, weight), sent to the partition of the target by local index
+        events = stimuli
+
+        partitions = [(self.template, self.parameters, np.arange(worker, self.n_cells, n_workers), dt, v_init, method,
+                       list(record), record_gids) for worker in range(n_workers)]
+        # Workers are processes reached through pipes, or the partition itself when there is one
+        workers, processes = [], []
+        try:
+            if n_workers == 1:
+                workers = [_Partition(*partitions[0])]
+            else:
+                context = multiprocessing.get_context()
+                for arguments in partitions:
+                    connection, child = context.Pipe()
+                    processes.append(context.Process(target=_worker, args=(child,) + arguments, daemon=True))
+                    processes[-1].start()
+                    # Only the worker holds the other end, so that its exit closes the pipe
+                    child.close()
+                    workers.append(connection)
+
+            spike_gids, spike_times = [], []
+            for stop_step in range(interval, step_count + interval, interval):
+                stop_step = min(stop_step, step_count)
+                worker_of = events[0].astype(int) % n_workers
+                messages = [(stop_step, np.vstack((events[0, worker_of == w] // n_workers, events[1:, worker_of == w])))
+                            for w in range(n_workers)]
+                if n_workers == 1:
+                    spikes = workers[0].advance(*messages[0])
+                else:
+                    _send(workers, processes, messages)
+                    spikes = np.concatenate(_receive(workers, processes), axis=1)
+                spike_gids.append(spikes[0].astype(int))
+                spike_times.append(spikes[1])
+
+                # Every spike becomes an event at each target of its source, through the source's range of connections
+                first, count = outgoing[spike_gids[-1]], np.diff(outgoing)[spike_gids[-1]]
+                index = np.repeat(first - np.cumsum(count) + count, count) + np.arange(count.sum())
+                events = np.vstack((connections[1, index], connections[4, index],
+                                    np.repeat(spikes[1], count) + connections[3, index], connections[2, index]))
+
+            if n_workers == 1:
+                recordings = [workers[0].recordings()]
+            else:
+                _send(workers, processes, [None] * n_workers)
+                recordings = _receive(workers, processes)
+        except BaseException:
+            # The other workers would wait for messages forever
+            for process in processes:
+                process.terminate()
+            raise
+        finally:
+            for process in processes:
+                process.join()
+
+        gids = np.concatenate([gids for gids, _ in recordings])
+        V_m = np.concatenate([traces for _, traces in recordings])
+        order = np.argsort(gids)
+        spike_gids, spike_times = np.concatenate(spike_gids), np.concatenate(spike_times)
+        spike_order = np.lexsort((spike_gids, spike_times))
+        labels = [f'{name}({x})' for name, x in record]
+        return CableNetworkResults(np.arange(step_count + 1) * dt, V_m[order], gids[order], labels,
+                                   spike_gids[spike_order], spike_times[spike_order])
+
+
+def benchmark_ring(n_cells: int = 2000, tstop: float = 40, nseg: int = 21) -> None:
+    """
+    Reports the time of a ring of ball-and-stick cells, driven at every fiftieth cell, simulated in one process and
+    in as many as there are CPUs, along with the number of spikes.
+    """
+    import functools
+    template = CellTemplate(functools.partial(ball_and_stick_cell, nseg))
+    network = CableNetwork.chain(n_cells, ring=True, template=template)
+    network.stimulate(np.arange(0, n_cells, 50))
+    for n_workers in sorted({1, os.cpu_count()}):
+        start = time.perf_counter()
+        results = network.simulate(tstop, n_workers, record_gids=[])
+        print(f'{n_cells} cells, {n_workers} process(es): {time.perf_counter() - start:.2f} s, '
+              f'{len(results.spike_times)} spikes')
+
+
+if __name__ == '__main__':
+    benchmark_ring()
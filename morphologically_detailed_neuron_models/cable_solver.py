@@ -0,0 +1,503 @@
+import time
+import numpy as np
+
+from dataclasses import dataclass, field
+
+
+# NEURON's defaults, which the cable scripts rely on
+DT = 0.025          # Simulation time interval [ms]
+V_INIT = -65        # Initial membrane potential [mV]
+
+METHODS = ('backward_euler', 'crank_nicolson')
+
+
+def _vtrap(x: np.ndarray, y: float) -> np.ndarray:
+    # x / (exp(x / y) - 1), and its limit where x / y vanishes, as in NEURON's hh.mod
+    small = np.abs(x / y) < 1e-6
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(small, y * (1 - x / y / 2), x / np.expm1(x / y))
+
+
+def _hh_rates(v: np.ndarray) -> np.ndarray:
+    # Steady states and time constants of m, h and n at 6.3 degC, where the q10 factor of hh.mod is one
+    alpha = 0.1 * _vtrap(-(v + 40), 10)
+    beta = 4 * np.exp(-(v + 65) / 18)
+    m_inf, m_tau = alpha / (alpha + beta), 1 / (alpha + beta)
+    alpha = 0.07 * np.exp(-(v + 65) / 20)
+    beta = 1 / (np.exp(-(v + 35) / 10) + 1)
+    h_inf, h_tau = alpha / (alpha + beta), 1 / (alpha + beta)
+    alpha = 0.01 * _vtrap(-(v + 55), 10)
+    beta = 0.125 * np.exp(-(v + 65) / 80)
+    n_inf, n_tau = alpha / (alpha + beta), 1 / (alpha + beta)
+    return np.array([m_inf, m_tau, h_inf, h_tau, n_inf, n_tau])
+
+
+# NEURON tabulates the hh rates from -100 to 100 mV by 1 mV, and interpolates them linearly
+_HH_TABLE_V = np.linspace(-100, 100, 201)
+_HH_TABLE = _hh_rates(_HH_TABLE_V)
+
+
+def hh_rates(v: np.ndarray, use_table: bool = True) -> np.ndarray:
+    """
+    Returns m_inf, m_tau, h_inf, h_tau, n_inf and n_tau at the membrane potentials v, stacked along a first axis,
+    interpolated from NEURON's table when use_table is set, and clamped at the ends of the table.
+    """
+    if not use_table:
+        return _hh_rates(np.asarray(v, dtype=float))
+    position = np.clip(np.asarray(v, dtype=float) - _HH_TABLE_V[0], 0, len(_HH_TABLE_V) - 1)
+    index = np.minimum(position.astype(int), len(_HH_TABLE_V) - 2)
+    theta = position - index
+    return _HH_TABLE[:, index] + theta * (_HH_TABLE[:, index + 1] - _HH_TABLE[:, index])
+
+
+@dataclass
+class Hh:
+    """
+    NEURON's hh mechanism: Hodgkin-Huxley sodium, potassium and leak currents, whose gates are integrated
+    exponentially with the membrane potential held over each step.
+    """
+    linear = False              # Whether the conductance is constant, so that it can be factorized once
+    gnabar: float = 0.12        # Sodium conductance        [S/cm2]
+    gkbar: float = 0.036        # Potassium conductance     [S/cm2]
+    gl: float = 0.0003          # Leak conductance          [S/cm2]
+    el: float = -54.3           # Leak reversal potential   [mV]
+    ena: float = 50             # Sodium reversal potential [mV]
+    ek: float = -77             # Potassium reversal potential [mV]
+    use_table: bool = True
+
+    def initial_state(self, v: np.ndarray) -> np.ndarray:
+        rates = hh_rates(v, self.use_table)
+        return rates[0::2].copy()   # m, h and n at their steady states
+
+    def current(self, v: np.ndarray, state: np.ndarray) -> tuple:
+        """
+        Returns the current density [mA/cm2] and its conductance [S/cm2], the derivative of the current with respect
+        to v with the gates held, as NEURON linearizes the membrane currents over a step.
+        """
+        m, h, n = state
+        g_na = self.gnabar * m * m * m * h
+        g_k = self.gkbar * n * n * n * n
+        current = g_na * (v - self.ena) + g_k * (v - self.ek) + self.gl * (v - self.el)
+        return current, g_na + g_k + self.gl
+
+    def advance(self, v: np.ndarray, state: np.ndarray, dt: float) -> np.ndarray:
+        rates = hh_rates(v, self.use_table)
+        steady, tau = rates[0::2], rates[1::2]
+        return state + -np.expm1(-dt / tau) * (steady - state)
+
+
+@dataclass
+class Pas:
+    """
+    NEURON's pas mechanism: a passive leak current.
+    """
+    linear = True
+    g: float = 0.001            # Leak conductance          [S/cm2]
+    e: float = -70              # Leak reversal potential   [mV]
+
+    def initial_state(self, v: np.ndarray) -> np.ndarray:
+        return np.empty((0,) + np.shape(v))
+
+    def current(self, v: np.ndarray, state: np.ndarray) -> tuple:
+        return self.g * (v - self.e), self.g
+
+    def advance(self, v: np.ndarray, state: np.ndarray, dt: float) -> np.ndarray:
+        return state
+
+
+@dataclass(eq=False)
+class Section:
+    """
+    An unbranched cylindrical cable, discretized into nseg segments of equal length, as a NEURON section. Its defaults
+    are NEURON's.
+    """
+    name: str
+    L: float = 100              # Length                    [um]
+    diam: float = 500           # Diameter                  [um]
+    nseg: int = 1               # Number of segments
+    Ra: float = 35.4            # Axial resistivity         [Ohm * cm]
+    cm: float = 1               # Membrane capacitance      [uF / cm^2]
+    mechanisms: list = field(default_factory=list)
+    parent: 'Section' = field(default=None, repr=False)
+    parent_x: float = 1.0       # Location on the parent that the 0 end of the section is connected to
+    children: list = field(default_factory=list, repr=False)
+
+    def insert(self, mechanism) -> None:
+        self.mechanisms.append(mechanism)
+
+    def connect(self, parent: 'Section', x: float = 1.0) -> None:
+        """
+        Connects the 0 end of the section to the location x of the parent, like NEURON's child.connect(parent(x)).
+        """
+        assert self.parent is None, f'{self.name} is already connected'
+        self.parent = parent
+        self.parent_x = x
+        parent.children.append(self)
+
+    @property
+    def segment_area(self) -> float:
+        return np.pi * self.diam * self.L / self.nseg                                   # [um^2]
+
+    @property
+    def half_segment_resistance(self) -> float:
+        # Ra [Ohm cm] * length [um] / cross section [um^2], times 1e4 um/cm for Ohm, and 1e-6 for MOhm
+        return self.Ra * (self.L / self.nseg / 2) / (np.pi * self.diam ** 2 / 4) * 1e-2  # [MOhm]
+
+    def tree(self) -> list:
+        """
+        Returns the section and all of its descendants, every section after its parent.
+        """
+        return [self] + [section for child in self.children for section in child.tree()]
+
+
+@dataclass
+class IClamp:
+    """
+    Current clamp, injecting amp from delay to delay + dur, like NEURON's IClamp. The clamp is on at the steps
+    whose middle falls within [delay, delay + dur).
+    """
+    section: Section
+    x: float = 0.5
+    delay: float = 0            # [ms]
+    dur: float = 0              # [ms]
+    amp: float = 0              # [nA]
+
+
+@dataclass
+class ExpSyn:
+    """
+    Synapse of NEURON's ExpSyn: a conductance that jumps by the weight of every event it receives, and decays
+    exponentially, with the current g * (v - e). Its defaults are NEURON's.
+    """
+    section: Section
+    x: float = 0.5
+    tau: float = 0.1            # Decay time constant       [ms]
+    e: float = 0                # Reversal potential        [mV]
+
+
+@dataclass
+class CableResults:
+    times: np.ndarray           # Time array                    [ms]
+    V_m: np.ndarray             # Membrane potential            [mV], of shape ([n_configs,] n_records, len(times))
+    labels: list                # The recorded locations, as 'section(x)'
+
+
+def hines_eliminate(parent: list, d: list, offdiagonal: list, nodes) -> None:
+    """
+    Eliminates the given nodes, in descending order, from the diagonal d of a tree-structured system, in place. The
+    only off-diagonal entries of the system couple every node i > 0 with its parent, parent[i] < i, by
+    offdiagonal[i]. Entries of d are scalars or arrays of several systems, so that nodes whose subtree is the same in
+    all systems can be eliminated once, and shared.
+    """
+    for i in nodes:
+        d[parent[i]] = d[parent[i]] - offdiagonal[i] * offdiagonal[i] / d[i]
+
+
+def hines_substitute(parent: list, d: list, offdiagonal: list, rhs: np.ndarray) -> np.ndarray:
+    """
+    Solves the system whose diagonal has been eliminated, for the right-hand sides rhs of shape (n_nodes, ...), by
+    eliminating them from the leaves to the root, and substituting the solution back from the root to the leaves.
+    """
+    # The rows are handled as separate arrays, or scalars, which is cheaper than indexing rhs at every node
+    rows = list(rhs)
+    for i in range(len(d) - 1, 0, -1):
+        p = parent[i]
+        rows[p] = rows[p] - offdiagonal[i] / d[i] * rows[i]
+    rows[0] = rows[0] / d[0]
+    for i in range(1, len(d)):
+        rows[i] = (rows[i] - offdiagonal[i] * rows[parent[i]]) / d[i]
+    return np.array(rows)
+
+
+class Cell:
+    """
+    Compartmental model of a tree of sections, discretized like NEURON: a node at the center of every segment, a node
+    of zero area at the 1 end of every section, and one at the 0 end of the root section, to which no membrane
+    current is attached. Nodes are ordered from the root, every node after its parent, so that the Hines algorithm
+    solves the cable equation in O(N). Units are mV, ms, nA, uS and nF.
+    """
+
+    def __init__(self, root: Section) -> None:
+        """
+        Discretizes the tree of sections from its root.
+
+        Args:
+            root (Section): The section without a parent, such as the soma
+        """
+        assert root.parent is None, 'The root section cannot have a parent'
+        self.root = root
+        self.sections = root.tree()
+        parent, conductance, area = [-1], [0.0], [0.0]
+        capacitance = [0.0]
+        self._first_node = {}
+        for section in self.sections:
+            self._first_node[section] = len(parent)
+            attachment = 0 if section is root else self.node(section.parent, section.parent_x)
+            resistance = section.half_segment_resistance
+            for k in range(section.nseg + 1):
+                # Segment centers are a segment apart, and half a segment from the ends of the section
+                parent.append(attachment if k == 0 else len(parent) - 1)
+                conductance.append(1 / (resistance if k in (0, section.nseg) else 2 * resistance))
+                center = k < section.nseg
+                area.append(section.segment_area if center else 0.0)
+                capacitance.append(section.cm * section.segment_area * 1e-5 if center else 0.0)
+
+        self.parent = np.array(parent)
+        self.conductance = np.array(conductance)            # Axial conductance to the parent node    [uS]
+        self.area = np.array(area)                          # Membrane area                           [um^2]
+        self.capacitance = np.array(capacitance)            # Membrane capacitance                    [nF]
+        # Each node's axial conductance to all of its neighbors, the diagonal of the axial part of the system
+        self.axial_diagonal = self.conductance.copy()
+        np.add.at(self.axial_diagonal, self.parent[1:], self.conductance[1:])
+
+        # The membrane nodes of every mechanism, by section
+        self.mechanisms = []
+        for section in self.sections:
+            nodes = self._first_node[section] + np.arange(section.nseg)
+            self.mechanisms.extend((mechanism, nodes) for mechanism in section.mechanisms)
+
+    def __len__(self) -> int:
+        return len(self.parent)
+
+    def node(self, section: Section, x: float) -> int:
+        """
+        Returns the node of the location x of the section, as NEURON maps locations to nodes: the 0 end is the node
+        that the section is connected to, the 1 end is its own end node, and x in between is the center of the
+        segment that contains it.
+        """
+        assert 0 <= x <= 1, 'Locations are between 0 and 1'
+        if x == 0:
+            return 0 if section is self.root else self.node(section.parent, section.parent_x)
+        if x == 1:
+            return self._first_node[section] + section.nseg
+        return self._first_node[section] + min(int(x * section.nseg), section.nseg - 1)
+
+    def simulate(self, tstop: float, dt: float = DT, v_init: float = V_INIT, stimuli: list = (), record: list = (),
+                 method: str = 'backward_euler') -> CableResults:
+        """
+        Simulates the cell from rest at v_init, as NEURON's finitialize and run. Every step linearizes the membrane
+        currents around the present potentials, solves the cable equation implicitly, and then advances the gates
+        with the new potentials, so gates and potentials are staggered by half a step. Stimuli are evaluated at the
+        middle of each step.
+
+        Args:
+            tstop (float): Simulation time                                              [ms]
+            dt (float): Simulation time interval                                        [ms]
+            v_init (float): Initial membrane potential of every node                    [mV]
+            stimuli (list): Current clamps of the cell
+            record (list): (section, x) locations whose potentials are recorded
+            method (str): 'backward_euler', first order, or 'crank_nicolson', second order in the potentials, as
+                          NEURON's secondorder = 0 and 1
+
+        Returns:
+            results (CableResults): The recorded potentials at every step, starting at 0
+        """
+        results = self.simulate_batch(tstop, [stimuli], dt, v_init, record, method)
+        return CableResults(results.times, results.V_m[0], results.labels)
+
+    def simulate_batch(self, tstop: float, configs: list, dt: float = DT, v_init: float = V_INIT, record: list = (),
+                       method: str = 'backward_euler') -> CableResults:
+        """
+        Simulates the cell under many stimulus configurations at once, such as sweeps of clamp amplitudes, delays and
+        locations, like simulate for each of them. All configurations are solved together as one block-diagonal
+        system, with every operation vectorized across them. The nodes whose subtree has a constant diagonal, such
+        as passive dendrites, are eliminated once and shared by all configurations and steps, so that every step
+        only eliminates the path from the active nodes to the root, before substituting back.
+
+        Args:
+            tstop (float): Simulation time                                              [ms]
+            configs (list): A list of current clamps per configuration
+            dt (float): Simulation time interval                                        [ms]
+            v_init (float): Initial membrane potential of every node                    [mV]
+            record (list): (section, x) locations whose potentials are recorded
+            method (str): 'backward_euler' or 'crank_nicolson', as in simulate
+
+        Returns:
+            results (CableResults): The recorded potentials, of shape (n_configs, n_records, len(times))
+        """
+        batch = CellBatch(self, configs, dt, v_init, method)
+        step_count = int(round(tstop / dt))
+        recorded = [self.node(section, x) for section, x in record]
+        V_m = np.empty((len(configs), len(recorded), step_count + 1))
+        V_m[..., 0] = batch.v[recorded].T
+        for step in range(step_count):
+            batch.step()
+            V_m[..., step + 1] = batch.v[recorded].T
+
+        labels = [f'{section.name}({x})' for section, x in record]
+        return CableResults(np.arange(step_count + 1) * dt, V_m, labels)
+
+    def _factorize(self, diagonal: np.ndarray, offdiagonal: list, active_nodes: np.ndarray = (),
+                   batch_shape: tuple = ()) -> tuple:
+        # Adds the constant conductances of the linear mechanisms to the diagonal, and eliminates every node whose
+        # subtree has no nonlinear mechanism, nor any of the given active nodes, such as synapses. Conductances that
+        # differ across the copies of a batch make their diagonal entries arrays. Returns the shared diagonal, and
+        # the remaining nodes to eliminate at every step, in descending order: the active nodes and their ancestors
+        diagonal = diagonal.copy()
+        varying = []
+        active = np.zeros(len(self), dtype=bool)
+        active[np.asarray(active_nodes, dtype=int)] = True
+        for mechanism, nodes in self.mechanisms:
+            if mechanism.linear:
+                v = np.zeros((len(nodes),) + batch_shape)
+                conductance = np.asarray(mechanism.current(v, mechanism.initial_state(v))[1])
+                if conductance.ndim == 0:
+                    diagonal[nodes] += conductance * self.area[nodes] * 1e-2
+                else:
+                    area = self.area[nodes].reshape((-1,) + (1,) * len(batch_shape)) * 1e-2
+                    varying.extend(zip(nodes.tolist(), np.broadcast_to(conductance, v.shape) * area))
+            else:
+                active[nodes] = True
+        for i in range(len(self) - 1, 0, -1):
+            active[self.parent[i]] |= active[i]
+
+        shared = diagonal.tolist()
+        for node, conductance in varying:
+            shared[node] = shared[node] + conductance
+        hines_eliminate(self.parent, shared, offdiagonal, [i for i in range(len(self) - 1, 0, -1) if not active[i]])
+        return shared, [i for i in range(len(self) - 1, 0, -1) if active[i]]
+
+
+class CellBatch:
+    """
+    Copies of a cell, one per stimulus configuration, advanced together one step at a time, as Cell.simulate_batch
+    does, for simulations that interleave steps with events, such as networks. Synapses are shared by all copies,
+    with a conductance per copy, which events raise. Mechanism parameters may be arrays over the copies, which makes
+    them different cells of the same morphology.
+    """
+
+    def __init__(self, cell: Cell, configs: list, dt: float = DT, v_init: float = V_INIT,
+                 method: str = 'backward_euler', synapses: list = ()) -> None:
+        """
+        Initializes every copy at rest at v_init, at time 0.
+
+        Args:
+            cell (Cell): The discretized cell
+            configs (list): A list of current clamps per copy
+            dt (float): Simulation time interval                                        [ms]
+            v_init (float): Initial membrane potential of every node                    [mV]
+            method (str): 'backward_euler' or 'crank_nicolson', as in Cell.simulate
+            synapses (list): ExpSyn synapses of the cell, present in every copy
+        """
+        assert method in METHODS, f'method must be one of {METHODS}'
+        self.cell = cell
+        self.dt = dt
+        self.step_count = 0
+        # Crank-Nicolson solves for the potentials half a step ahead, and extrapolates them to the full step
+        self._half_steps = 2 if method == 'crank_nicolson' else 1
+        # A single copy is simulated without a copy axis, as the Hines loops are much cheaper on scalars than on
+        # arrays of one element
+        self.batch_shape = (len(configs),) if len(configs) > 1 else ()
+        column = (-1,) + (1,) * len(self.batch_shape)
+
+        # Clamps of all copies, flattened, so that their currents are evaluated at once
+        clamps = np.array([(cell.node(c.section, c.x), k, c.delay, c.delay + c.dur, c.amp)
+                           for k, config in enumerate(configs) for c in config]).reshape(-1, 5).T
+        self._clamp_index = (clamps[0].astype(int), clamps[1].astype(int))[:1 + len(self.batch_shape)]
+        self._clamp_start, self._clamp_stop, self._clamp_amp = clamps[2:]
+
+        # Synaptic conductances change at every step, so their nodes are factorized like active membrane
+        self._synapse_nodes = np.array([cell.node(s.section, s.x) for s in synapses], dtype=int)
+        self._synapse_e = np.array([s.e for s in synapses], dtype=float).reshape(column)
+        self._synapse_decay = np.exp(-dt / np.array([s.tau for s in synapses], dtype=float)).reshape(column)
+        self.g = np.zeros((len(synapses),) + self.batch_shape)             # Synaptic conductances    [uS]
+
+        self._parent = cell.parent.tolist()
+        self._offdiagonal = (-cell.conductance).tolist()
+        self._shared, self._active_path = cell._factorize(
+            cell.capacitance * self._half_steps / dt + cell.axial_diagonal, self._offdiagonal, self._synapse_nodes,
+            self.batch_shape)
+        self._axial = cell.conductance[1:].reshape(column)
+        self._area = cell.area.reshape(column) * 1e-2
+
+        self.v = np.full((len(cell),) + self.batch_shape, float(v_init))  # Membrane potentials     [mV]
+        self.states = [mechanism.initial_state(self.v[nodes]) for mechanism, nodes in cell.mechanisms]
+
+    @property
+    def t(self) -> float:
+        return self.step_count * self.dt
+
+    def deliver(self, synapses: np.ndarray, copies: np.ndarray, weights: np.ndarray) -> None:
+        """
+        Raises the conductance of the given synapses of the given copies by the weights of their events [uS].
+        """
+        index = (synapses, copies) if self.batch_shape else (synapses,)
+        np.add.at(self.g, index, weights)
+
+    def step(self) -> None:
+        """
+        Advances every copy by one step. Stimuli are evaluated at the middle of the step.
+        """
+        cell, v = self.cell, self.v
+        t = self.t + self.dt / 2
+        rhs = np.zeros(v.shape)
+        on = (self._clamp_start <= t) & (t < self._clamp_stop)
+        np.add.at(rhs, self._clamp_index, np.where(on, self._clamp_amp, 0.0))
+
+        # Axial currents flowing into every node
+        flow = self._axial * (v[cell.parent[1:]] - v[1:])
+        rhs[1:] += flow
+        np.add.at(rhs, cell.parent[1:], -flow)
+
+        # Membrane currents, in nA and uS from mA/cm2 and S/cm2 over um^2, where only the conductances of the
+        # nonlinear mechanisms and the synapses change the diagonal
+        d = list(self._shared)
+        for (mechanism, nodes), state in zip(cell.mechanisms, self.states):
+            current, conductance = mechanism.current(v[nodes], state)
+            rhs[nodes] -= current * self._area[nodes]
+            if not mechanism.linear:
+                for node, g in zip(nodes.tolist(), conductance * self._area[nodes]):
+                    d[node] = d[node] + g
+        if len(self._synapse_nodes):
+            np.add.at(rhs, self._synapse_nodes, -self.g * (v[self._synapse_nodes] - self._synapse_e))
+            for node, g in zip(self._synapse_nodes.tolist(), self.g):
+                d[node] = d[node] + g
+        hines_eliminate(self._parent, d, self._offdiagonal, self._active_path)
+
+        v += self._half_steps * hines_substitute(self._parent, d, self._offdiagonal, rhs)
+        self.states = [mechanism.advance(v[nodes], state, self.dt)
+                       for (mechanism, nodes), state in zip(cell.mechanisms, self.states)]
+        self.g *= self._synapse_decay
+        self.step_count += 1
+
+
+def ball_and_stick(nseg: int = 101) -> tuple:
+    """
+    Returns the soma and the dendrite of the ball-and-stick cell of the cable scripts, with the dendrite in nseg
+    segments.
+    """
+    soma = Section('soma', L=12.6157, diam=12.6157, Ra=100, cm=1)
+    soma.insert(Hh(gnabar=0.12, gkbar=0.036, gl=0.0003, el=-54.3))
+    dend = Section('dend', L=200, diam=1, nseg=nseg, Ra=100, cm=1)
+    dend.insert(Pas(g=0.001, e=-65))
+    dend.connect(soma, 1)
+    return soma, dend
+
+
+def benchmark_sweep(amplitudes: np.ndarray = np.linspace(0, 0.5, 200), tstop: float = 25, sample: int = 10) -> None:
+    """
+    Reports the time of a sweep of clamp amplitudes at the tip of the ball-and-stick dendrite, simulated at once and
+    one amplitude at a time, estimated from a sample of the amplitudes, along with the lowest amplitude that makes
+    the soma spike.
+    """
+    soma, dend = ball_and_stick()
+    cell = Cell(soma)
+    configs = [[IClamp(dend, 1, delay=5, dur=1, amp=amp)] for amp in amplitudes]
+
+    start = time.perf_counter()
+    results = cell.simulate_batch(tstop, configs, record=[(soma, 0.5)])
+    batch_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for config in configs[:sample]:
+        cell.simulate(tstop, stimuli=config, record=[(soma, 0.5)])
+    sequential_time = (time.perf_counter() - start) / sample * len(configs)
+
+    spiking = results.V_m[:, 0].max(axis=1) > 0
+    threshold = f'{amplitudes[spiking.argmax()]:.4f} nA' if spiking.any() else 'none'
+    print(f'{len(configs)} amplitudes: batch {batch_time:.2f} s, sequential ~{sequential_time:.2f} s '
+          f'({sequential_time / batch_time:.1f}x), spike threshold {threshold}')
+
+
+if __name__ == '__main__':
+    benchmark_sweep()
@@ -0,0 +1,186 @@
+import time
+import tracemalloc
+import dataclasses
+import numpy as np
+
+from cable_solver import DT, V_INIT, Cell, CellBatch, ExpSyn, ball_and_stick
+
+
+def ball_and_stick_cell(nseg: int = 101) -> tuple:
+    """
+    Builds the cell of the compartmental model: the ball-and-stick cell, with an ExpSyn at the middle of the
+    dendrite, and spikes detected at the middle of the soma.
+
+    Returns:
+        root (Section): The soma
+        synapses (list): The ExpSyn synapses, which connections target by index
+        source (tuple): The (section, x) location whose potential crossing the spike threshold is a spike
+    """
+    soma, dend = ball_and_stick(nseg)
+    return soma, [ExpSyn(dend, 0.5)], (soma, 0.5)
+
+
+def _mechanism_parameters(root) -> dict:
+    # The numeric parameters of every mechanism of the tree, named as NEURON's range variables, such as
+    # 'soma.gnabar_hh', with their values
+    parameters = {}
+    for section in root.tree():
+        for mechanism in section.mechanisms:
+            suffix = type(mechanism).__name__.lower()
+            for field in dataclasses.fields(mechanism):
+                value = getattr(mechanism, field.name)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    parameters[f'{section.name}.{field.name}_{suffix}'] = value
+    return parameters
+
+
+class CellTemplate:
+    """
+    A morphology and its mechanisms, defined once by a build function, and instantiated as populations of cells that
+    share one discretization. Cells of a population may differ in their mechanism parameters, given as arrays over
+    the cells, and named as NEURON's range variables, such as 'soma.gnabar_hh' or 'dend.g_pas'.
+    """
+
+    def __init__(self, build=ball_and_stick_cell) -> None:
+        """
+        Args:
+            build: Module-level function, or functools.partial of one, returning a cell as ball_and_stick_cell. It
+                   must be picklable for the template to be sent to worker processes
+        """
+        self.build = build
+        self.parameters = _mechanism_parameters(build()[0])     # Parameter name -> default value
+
+    def instantiate(self, n_cells: int, parameters: dict = None) -> 'CellPopulation':
+        """
+        Returns n_cells cells of the template, with the given parameters, scalars or arrays of n_cells values,
+        and the defaults of the build function otherwise.
+        """
+        return CellPopulation(self, n_cells, parameters or {})
+
+
+class CellPopulation:
+    """
+    Cells of a template, built and discretized once as a single Cell, whose mechanisms hold the parameters that
+    differ across cells as arrays. The cells are simulated together, as the copies of a CellBatch, and reached by
+    lightweight handles created on access, instead of sections per cell.
+    """
+
+    def __init__(self, template: CellTemplate, n_cells: int, parameters: dict) -> None:
+        assert n_cells >= 1, 'A population needs at least one cell'
+        unknown = set(parameters) - set(template.parameters)
+        assert not unknown, f'Unknown parameters {sorted(unknown)}, the template has {sorted(template.parameters)}'
+        self.template = template
+        self.n_cells = n_cells
+        root, self.synapses, (source_section, source_x) = template.build()
+        self.sections = {section.name: section for section in root.tree()}
+
+        self.parameters = {}
+        for name, values in parameters.items():
+            values = np.broadcast_to(np.asarray(values, dtype=float), (n_cells,))
+            self.parameters[name] = values
+            section_name, variable = name.split('.')
+            parameter, suffix = variable.rsplit('_', 1)
+            mechanisms = self.sections[section_name].mechanisms
+            k = next(k for k, mechanism in enumerate(mechanisms) if type(mechanism).__name__.lower() == suffix)
+            # A single cell is simulated without a copy axis, so its parameters stay scalars
+            value = values.copy() if n_cells > 1 else float(values[0])
+            mechanisms[k] = dataclasses.replace(mechanisms[k], **{parameter: value})
+
+        self.cell = Cell(root)
+        self.source = self.cell.node(source_section, source_x)
+        self.batch = None
+
+    def __len__(self) -> int:
+        return self.n_cells
+
+    def __getitem__(self, index: int) -> 'CellHandle':
+        assert -self.n_cells <= index < self.n_cells, f'Cell {index} is out of the {self.n_cells} cells'
+        return CellHandle(self, index % self.n_cells)
+
+    def __iter__(self):
+        return (CellHandle(self, index) for index in range(self.n_cells))
+
+    def node(self, section: str, x: float = 0.5) -> int:
+        """
+        Returns the node of the location x of the named section, shared by all cells.
+        """
+        return self.cell.node(self.sections[section], x)
+
+    def initialize(self, configs: list = None, dt: float = DT, v_init: float = V_INIT,
+                   method: str = 'backward_euler') -> CellBatch:
+        """
+        Initializes the cells at rest, with a list of current clamps per cell, on the sections of the population,
+        and returns their CellBatch, which steps them.
+        """
+        configs = configs if configs is not None else [[] for _ in range(self.n_cells)]
+        assert len(configs) == self.n_cells, 'A list of clamps is needed per cell'
+        self.batch = CellBatch(self.cell, configs, dt, v_init, method, self.synapses)
+        return self.batch
+
+
+class CellHandle:
+    """
+    One cell of a population, by its index, holding no state of its own.
+    """
+    __slots__ = ('population', 'index')
+
+    def __init__(self, population: CellPopulation, index: int) -> None:
+        self.population = population
+        self.index = index
+
+    def __repr__(self) -> str:
+        return f'CellHandle({self.index})'
+
+    @property
+    def parameters(self) -> dict:
+        """
+        Returns the parameters of the cell, by name.
+        """
+        parameters = dict(self.population.template.parameters)
+        parameters.update((name, float(values[self.index])) for name, values in self.population.parameters.items())
+        return parameters
+
+    def v(self, section: str, x: float = 0.5) -> float:
+        """
+        Returns the present membrane potential of the cell at the location x of the named section [mV].
+        """
+        batch = self.population.batch
+        assert batch is not None, 'The population is not initialized'
+        v = batch.v[self.population.node(section, x)]
+        return float(v[self.index] if batch.batch_shape else v)
+
+
+def benchmark_build(n_cells: int = 10000, sample: int = 200) -> None:
+    """
+    Reports the build time and memory of n_cells heterogeneous ball-and-stick cells, built and discretized one at
+    a time, estimated from a sample of them, and instantiated from a template.
+    """
+    rng = np.random.default_rng(0)
+    parameters = {'soma.gnabar_hh': rng.uniform(0.1, 0.14, n_cells), 'dend.g_pas': rng.uniform(5e-4, 2e-3, n_cells)}
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    cells = {}
+    for i in range(sample):
+        soma, dend = ball_and_stick()
+        soma.mechanisms[0].gnabar = parameters['soma.gnabar_hh'][i]
+        dend.mechanisms[0].g = parameters['dend.g_pas'][i]
+        cells[i] = {'soma': soma, 'dend': dend, 'cell': Cell(soma)}
+    per_cell_time = (time.perf_counter() - start) / sample * n_cells
+    per_cell_memory = tracemalloc.get_traced_memory()[0] / sample * n_cells
+    del cells
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    population = CellTemplate().instantiate(n_cells, parameters)
+    template_time = time.perf_counter() - start
+    template_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f'{n_cells} cells: per cell ~{per_cell_time:.2f} s, ~{per_cell_memory / 2 ** 20:.1f} MiB; '
+          f'template {template_time:.4f} s, {template_memory / 2 ** 20:.2f} MiB, {len(population)} cells')
+
+
+if __name__ == '__main__':
+    benchmark_build()
@@ -0,0 +1,220 @@
+import os
+import json
+import hashlib
+import warnings
+import numpy as np
+
+from dataclasses import dataclass, field
+
+from cable_solver import DT, Cell, Section
+
+
+NORMS = ('max', 'rms')
+
+
+def lambda_f(section: Section, frequency: float = 100) -> float:
+    """
+    Returns the AC length constant of the section at the given frequency [Hz], in um, which the d_lambda rule
+    divides sections by.
+    """
+    return 1e5 * np.sqrt(section.diam / (4 * np.pi * frequency * section.Ra * section.cm))
+
+
+def d_lambda_nseg(section: Section, d_lambda: float = 0.1, frequency: float = 100) -> int:
+    """
+    Returns NEURON's d_lambda rule nseg of the section: the smallest odd number of segments that are at most
+    d_lambda of the AC length constant long.
+    """
+    return int((section.L / (d_lambda * lambda_f(section, frequency)) + 0.9) / 2) * 2 + 1
+
+
+def trace_error(traces: np.ndarray, reference: np.ndarray, norm: str = 'max') -> np.ndarray:
+    """
+    Returns the error of every recorded trace, of shape (..., T), against the reference, as the maximal absolute
+    difference or its root mean square over time.
+    """
+    difference = np.abs(traces - reference)
+    return difference.max(axis=-1) if norm == 'max' else np.sqrt(np.mean(difference ** 2, axis=-1))
+
+
+@dataclass
+class NsegRecommendation:
+    nseg: dict                  # Section name -> recommended nseg
+    error: float                # Error of the recommended discretization against the reference  [mV]
+    reference: dict             # Section name -> nseg of the reference discretization
+    errors: dict = field(default_factory=dict)  # Section name -> [(nseg, error)] of every tested nseg, by nseg
+
+    def apply(self, root: Section) -> None:
+        """
+        Sets the recommended nseg of every section of the tree.
+        """
+        for section in root.tree():
+            section.nseg = self.nseg[section.name]
+
+
+class NsegCache:
+    """
+    Memoizes nseg recommendations in a JSON file, keyed on a hash of the morphology, its mechanisms, the stimuli,
+    the recording sites and the study settings, so that the convergence study of a morphology runs once.
+    """
+
+    def __init__(self, path: str = None) -> None:
+        self.path = path
+        self._recommendations = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as file:
+                self._recommendations = json.load(file)
+
+    def __len__(self) -> int:
+        return len(self._recommendations)
+
+    def get(self, key: str) -> NsegRecommendation:
+        entry = self._recommendations.get(key)
+        if entry is None:
+            return None
+        # JSON stores the (nseg, error) pairs as lists
+        errors = {name: [tuple(pair) for pair in pairs] for name, pairs in entry['errors'].items()}
+        return NsegRecommendation(entry['nseg'], entry['error'], entry['reference'], errors)
+
+    def put(self, key: str, recommendation: NsegRecommendation) -> None:
+        self._recommendations[key] = {'nseg': recommendation.nseg, 'error': recommendation.error,
+                                      'reference': recommendation.reference, 'errors': recommendation.errors}
+
+    def save(self, path: str = None) -> None:
+        path = path or self.path
+        assert path is not None, 'No path to save the cache to'
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(self._recommendations, file, indent=1)
+
+
+def study_key(root: Section, configs: list, record: list, **settings) -> str:
+    # Sections are described by their geometry, mechanisms and connection, clamps and recording sites by the
+    # sections they are on, so that the key does not depend on the identity of the objects
+    sections = [(s.name, s.L, s.diam, s.Ra, s.cm, [repr(m) for m in s.mechanisms],
+                 s.parent.name if s.parent is not None else None, s.parent_x) for s in root.tree()]
+    stimuli = [[(c.section.name, c.x, c.delay, c.dur, c.amp) for c in config] for config in configs]
+    sites = [(section.name, x) for section, x in record]
+    description = repr((sections, stimuli, sites, sorted(settings.items())))
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def _node_sites(section: Section, x: float) -> tuple:
+    # Returns the locations of the two nodes around x along the section, the 0 end, the segment centers and the 1
+    # end, and the weight of the second one in the linear interpolation at x
+    positions = np.concatenate(([0], (np.arange(section.nseg) + 0.5) / section.nseg, [1]))
+    j = min(int(np.searchsorted(positions, x, side='right')) - 1, len(positions) - 2)
+    weight = (x - positions[j]) / (positions[j + 1] - positions[j])
+    return float(positions[j]), float(positions[j + 1]), weight
+
+
+def _candidates(start: int, reference: int) -> list:
+    # Every odd nseg up to the d_lambda one, then tripling it, which keeps the previous nodes, up to the reference.
+    # The odd nseg skipped between a failing and a passing candidate are bisected by select_nseg
+    candidates = list(range(1, start + 1, 2))
+    while candidates[-1] * 3 < reference:
+        candidates.append(candidates[-1] * 3)
+    return candidates + [reference]
+
+
+def select_nseg(root: Section, configs: list, record: list, tstop: float, tolerance: float = 1.0,
+                norm: str = 'max', d_lambda: float = 0.1, frequency: float = 100, refinement: int = 9,
+                dt: float = DT, method: str = 'backward_euler', cache: NsegCache = None) -> NsegRecommendation:
+    """
+    Selects the smallest nseg of every section that simulates the recording sites within the tolerance of a
+    reference discretization, under the given stimulus configurations. The d_lambda rule gives a starting nseg per
+    section, refined refinement times for the reference. Every section is then scanned from one segment upward, with
+    the other sections at the reference: every odd nseg up to the d_lambda one, then tripling it, and the odd nseg
+    between the last failing and the first passing ones are bisected, assuming the error decreases with nseg, for
+    the smallest nseg within the tolerance. The combination of the selections is verified against the reference,
+    refining the section of largest error to its next candidate until it passes. Errors are
+    measured at the exact recording sites, interpolated linearly between the nodes around them, so that they measure
+    the discretization rather than the shift of the nodes that the sites map to. The nseg of the sections is left
+    unchanged, and the recommendation is applied by its apply method.
+
+    Args:
+        root (Section): Root of the morphology
+        configs (list): A list of current clamps per stimulus configuration, simulated at once
+        record (list): (section, x) recording sites where the error is measured
+        tstop (float): Simulation time                                                  [ms]
+        tolerance (float): Largest accepted error, over all configurations and sites    [mV]
+        norm (str): 'max' for the maximal absolute error over time, or 'rms' for its root mean square
+        d_lambda (float): Fraction of the AC length constant of the starting segments
+        frequency (float): Frequency of the AC length constant                          [Hz]
+        refinement (int): Odd factor from the d_lambda nseg to the reference nseg
+        dt (float): Simulation time interval, shared by all runs, so only the spatial error is measured   [ms]
+        method (str): Integration method of the runs
+        cache (NsegCache): Cache of the recommendations
+
+    Returns:
+        recommendation (NsegRecommendation): The selected nseg of every section, and the errors measured
+    """
+    assert norm in NORMS, f'norm must be one of {NORMS}'
+    assert refinement >= 3 and refinement % 2 == 1, 'The refinement must be odd, so the reference keeps the centers'
+    sections = root.tree()
+    assert len({s.name for s in sections}) == len(sections), 'Section names must be unique'
+    key = study_key(root, configs, record, tstop=tstop, tolerance=tolerance, norm=norm, d_lambda=d_lambda,
+                    frequency=frequency, refinement=refinement, dt=dt, method=method)
+    if cache is not None and cache.get(key) is not None:
+        return cache.get(key)
+
+    original = {s.name: s.nseg for s in sections}
+    start = {s.name: d_lambda_nseg(s, d_lambda, frequency) for s in sections}
+    reference = {name: nseg * refinement for name, nseg in start.items()}
+
+    def run(nseg: dict) -> np.ndarray:
+        for section in sections:
+            section.nseg = nseg[section.name]
+        sites = [_node_sites(section, x) for section, x in record]
+        nodes = [(section, x) for (section, _), (first, second, _) in zip(record, sites) for x in (first, second)]
+        V_m = Cell(root).simulate_batch(tstop, configs, dt, record=nodes, method=method).V_m
+        weights = np.array([weight for _, _, weight in sites])[:, np.newaxis]
+        return (1 - weights) * V_m[:, 0::2] + weights * V_m[:, 1::2]
+
+    def error(nseg: dict) -> float:
+        return float(trace_error(run(nseg), reference_traces, norm).max())
+
+    try:
+        reference_traces = run(reference)
+        selected, errors = {}, {}
+        for section in sections:
+            tested = {}
+            failing = None
+            for nseg in _candidates(start[section.name], reference[section.name]):
+                tested[nseg] = error({**reference, section.name: nseg})
+                if tested[nseg] <= tolerance:
+                    break
+                failing = nseg
+            passing = nseg
+            while failing is not None and passing - failing > 2:
+                middle = failing + (passing - failing) // 4 * 2
+                tested[middle] = error({**reference, section.name: middle})
+                failing, passing = (failing, middle) if tested[middle] <= tolerance else (middle, passing)
+            selected[section.name] = passing
+            errors[section.name] = sorted(tested.items())
+
+        # The errors of the sections add up when they are all coarse, so the combination is verified
+        combined = error(selected)
+        while combined > tolerance:
+            worst = max((name for name in selected if selected[name] < reference[name]),
+                        key=lambda name: dict(errors[name])[selected[name]], default=None)
+            if worst is None:
+                break
+            selected[worst] = next(nseg for nseg in _candidates(start[worst], reference[worst])
+                                   if nseg > selected[worst])
+            tested = dict(errors[worst])
+            if selected[worst] not in tested:
+                tested[selected[worst]] = error({**reference, worst: selected[worst]})
+            errors[worst] = sorted(tested.items())
+            combined = error(selected)
+    finally:
+        for section in sections:
+            section.nseg = original[section.name]
+
+    if combined > tolerance:
+        warnings.warn(f'The reference discretization is within {combined:.3g} mV only, refine it for a tolerance '
+                      f'of {tolerance} mV')
+    recommendation = NsegRecommendation(selected, combined, reference, errors)
+    if cache is not None:
+        cache.put(key, recommendation)
+    return recommendation
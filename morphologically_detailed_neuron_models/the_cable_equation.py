@@ -1,79 +1,124 @@
+import os
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 
-from neuron import h, gui
-
-
-# Model definition by a ball and a stick
-
-## Define the "Ball"
-soma = h.Section(name='soma') 
-soma.L = soma.diam = 12.6157    # [um]
-soma.Ra = 100                   # Axial resistance [Ohm * cm]
-soma.cm = 1                     # Membrane capacitance [uF / cm^2]
-soma.insert('hh')               # Insert active Hodgkin-Huxley current in the soma
-soma.gnabar_hh = 0.12           # Sodium conductance [S/cm2]
-soma.gkbar_hh = 0.036           # Potassium conductance [S/cm2]
-soma.gl_hh = 0.0003             # Leak conductance [S/cm2]
-soma.el_hh = -54.3              # Reversal potential [mV]
-
-## Define the "Stick"
-dend = h.Section(name='dend')
-dend.L = 200                    # [um]
-dend.nseg = 101
-dend.Ra = 100                   # Axial resistance [Ohm * cm]
-dend.cm = 1                     # Membrane capacitance [uF / cm^2]
-dend.diam = 1                   # [um]
-dend.insert('pas')              # Insert passive current in the dendrite
-dend.g_pas = 0.001              # Passive conductance [S/cm2] 
-dend.e_pas = -65                # Leak reversal potential [mV]
-dend.connect(soma(1)) 
-
-
-# Define stimulation
-stim = h.IClamp(dend(1))
-stim.delay = 5
-stim.dur = 1
+from cable_solver import Cell, IClamp, ball_and_stick
+from nseg_selection import NsegCache, select_nseg
+
+
+# Simulation parameters
+simdur = 25.0
 stim_amp_array = [0.1, 0.3]
+dend_locations = np.flip(np.linspace(0, 1, 6))  # Recorded locations along the dendrite, from its tip to the soma
+nseg_tolerance = 1.0                            # Largest error of the selected discretization at the recordings [mV]
+# The nseg studies are cached in the user's cache directory, out of the source tree
+nseg_cache_path = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                               'neuronal_dynamics', 'nseg_cache.json')
 
 
-# Recording vectors
-t_vec = h.Vector() 
-t_vec.record(h._ref_t)
-soma_v_vec = h.Vector()  
-soma_v_vec.record(soma(0.5)._ref_v)
-dend_v_vec_array = []
-string_array = []
-for i in np.flip(np.linspace(0, dend.L, 6)):
-    dend_v_vec = h.Vector()
-    string_array.append(f'{100 * (i / dend.L)} %')
-    dend_v_vec.record(dend(i / dend.L)._ref_v)
-    dend_v_vec_array.append(dend_v_vec)
+def build_native():
+    # Model definition by a ball and a stick, the "Ball" with active Hodgkin-Huxley currents, and the "Stick" with a
+    # passive current, connected to the end of the ball
+    soma, dend = ball_and_stick(nseg=101)
 
+    # Define stimulation at the tip of the dendrite, one configuration per amplitude, and the recorded locations
+    configs = [[IClamp(dend, 1, delay=5, dur=1, amp=amp)] for amp in stim_amp_array]
+    record = [(dend, x) for x in dend_locations] + [(soma, 0.5)]
+    return soma, configs, record
 
-# Simulation parameters
-simdur = 25.0
-h.tstop = simdur
+
+def recommend_nseg(cache_path=nseg_cache_path):
+    # The cheapest discretization within the tolerance replaces the 101 segments of both simulators. The study runs
+    # on the native model once per morphology, and is cached at cache_path, or not at all when it is None
+    cache = NsegCache(cache_path)
+    recommendation = select_nseg(*build_native(), simdur, tolerance=nseg_tolerance, cache=cache)
+    if cache_path is not None:
+        cache.save()
+    print(f'nseg {recommendation.nseg}, within {recommendation.error:.3f} mV of {recommendation.reference}')
+    return recommendation
+
+
+def simulate_native(cache_path=nseg_cache_path):
+    soma, configs, record = build_native()
+    recommend_nseg(cache_path).apply(soma)
+
+    # All amplitudes are simulated at once
+    results = Cell(soma).simulate_batch(simdur, configs, record=record)
+    for V_m in results.V_m:
+        yield results.times, V_m[:-1], V_m[-1]
+
+
+def simulate_neuron(cache_path=nseg_cache_path):
+    # The same model, simulated by NEURON, whose standard run library is loaded without its GUI
+    from neuron import h
+    h.load_file('stdrun.hoc')
+    nseg = recommend_nseg(cache_path).nseg
+
+    ## Define the "Ball"
+    soma = h.Section(name='soma')
+    soma.L = soma.diam = 12.6157    # [um]
+    soma.nseg = nseg['soma']
+    soma.Ra = 100                   # Axial resistance [Ohm * cm]
+    soma.cm = 1                     # Membrane capacitance [uF / cm^2]
+    soma.insert('hh')               # Insert active Hodgkin-Huxley current in the soma
+    soma.gnabar_hh = 0.12           # Sodium conductance [S/cm2]
+    soma.gkbar_hh = 0.036           # Potassium conductance [S/cm2]
+    soma.gl_hh = 0.0003             # Leak conductance [S/cm2]
+    soma.el_hh = -54.3              # Reversal potential [mV]
+
+    ## Define the "Stick"
+    dend = h.Section(name='dend')
+    dend.L = 200                    # [um]
+    dend.nseg = nseg['dend']
+    dend.Ra = 100                   # Axial resistance [Ohm * cm]
+    dend.cm = 1                     # Membrane capacitance [uF / cm^2]
+    dend.diam = 1                   # [um]
+    dend.insert('pas')              # Insert passive current in the dendrite
+    dend.g_pas = 0.001              # Passive conductance [S/cm2]
+    dend.e_pas = -65                # Leak reversal potential [mV]
+    dend.connect(soma(1))
+
+    # Define stimulation
+    stim = h.IClamp(dend(1))
+    stim.delay = 5
+    stim.dur = 1
+
+    # Recording vectors
+    t_vec = h.Vector()
+    t_vec.record(h._ref_t)
+    soma_v_vec = h.Vector()
+    soma_v_vec.record(soma(0.5)._ref_v)
+    dend_v_vec_array = []
+    for x in dend_locations:
+        dend_v_vec = h.Vector()
+        dend_v_vec.record(dend(x)._ref_v)
+        dend_v_vec_array.append(dend_v_vec)
+
+    h.tstop = simdur
+    for amp in stim_amp_array:
+        stim.amp = amp
+        h.run()
+        yield np.array(t_vec), np.array(dend_v_vec_array), np.array(soma_v_vec)
+
+    h('forall {delete_section()}')
 
 
-# Simulation and plotting
-for amp in stim_amp_array:
-    stim.amp = amp
-    h.run()
-    
-    cmap = plt.get_cmap('Blues')   
+# Simulation and plotting, with the native solver, or with NEURON when run with --neuron
+simulations = simulate_neuron() if len(sys.argv) > 1 and sys.argv[1] == '--neuron' else simulate_native()
+string_array = [f'{100 * x} %' for x in dend_locations]
+for t_vec, dend_v_vec_array, soma_v_vec in simulations:
+    cmap = plt.get_cmap('Blues')
     colors = cmap(np.linspace(0,1,len(dend_v_vec_array) * 2))
-    plt.figure(figsize=(8,4)) 
+    plt.figure(figsize=(8,4))
 
-    plt.plot(t_vec, dend_v_vec_array[0], label=f'dendrite @ {string_array[0]}', linewidth=3, color=colors[-1]) 
+    plt.plot(t_vec, dend_v_vec_array[0], label=f'dendrite @ {string_array[0]}', linewidth=3, color=colors[-1])
     for i, v in enumerate(dend_v_vec_array[1:]):
-        plt.plot(t_vec, v, label=f'dendrite @ {string_array[i + 1]}', color=colors[len(colors) - 2 - i]) 
+        plt.plot(t_vec, v, label=f'dendrite @ {string_array[i + 1]}', color=colors[len(colors) - 2 - i])
     plt.plot(t_vec, soma_v_vec, label='soma', color='red', linewidth=3)
     plt.title('Cable Equation', fontsize=15)
     plt.xlim([5, 11])
-    plt.xlabel('Time (ms)', fontsize=15) 
-    plt.ylabel('Membrane Potential (mV)', fontsize=15) 
+    plt.xlabel('Time (ms)', fontsize=15)
+    plt.ylabel('Membrane Potential (mV)', fontsize=15)
     plt.legend()
     plt.show()
-    
-h('forall {delete_section()}')
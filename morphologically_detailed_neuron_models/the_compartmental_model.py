@@ -1,108 +1,132 @@
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 
-from neuron import h, gui
+from cable_network import CableNetwork
+from cell_template import CellTemplate, ball_and_stick_cell
 
 
-# Model creation
+# Simulation parameters
 
-cells = {}
+simdur = 40
+n_cells = 3
+dend_locations = np.flip(np.linspace(0, 1, 6))  # Recorded locations along the dendrite of the first cell
 
-for i in range(3):
 
-    soma = h.Section(name='soma') 
-    soma.L = soma.diam = 12.6157    # [um]
-    soma.Ra = 100                   # Axial resistance [Ohm * cm]
-    soma.cm = 1                     # Membrane capacitance [uF / cm^2]
-    soma.insert('hh')               # Insert active Hodgkin-Huxley current in the soma
-    soma.gnabar_hh = 0.12           # Sodium conductance [S / cm2]
-    soma.gkbar_hh = 0.036           # Potassium conductance [S / cm2]
-    soma.gl_hh = 0.0003             # Leak conductance [S / cm2]
-    soma.el_hh = -54.3              # Reversal potential [mV]
+def simulate_native():
+    # The ball-and-stick cell, with an ExpSyn at the middle of its dendrite, is defined once, and all cells are
+    # instantiated from it
+    template = CellTemplate(ball_and_stick_cell)
 
-    dend = h.Section(name='dend')
-    dend.L = 200                    # [um]
-    dend.nseg = 101
-    dend.Ra = 100                   # Axial resistance [Ohm * cm]
-    dend.cm = 1                     # Membrane capacitance [uF / cm^2]
-    dend.diam = 1                   # [um]
-    dend.insert('pas')              # Insert passive current in the dendrite
-    dend.g_pas = 0.001              # Passive conductance [S / cm2] 
-    dend.e_pas = -65                # Leak reversal potential [mV]
-    dend.connect(soma(1)) 
-    
-    cells[i] = {'soma': soma, 'dend': dend}
+    # A chain of cells, each exciting the synapse of the next one when its soma spikes, and a single event to the
+    # first cell. Networks are split across processes by CELLS_PER_WORKER cells, so this one runs in this process
+    network = CableNetwork.chain(n_cells, weight=0.04, delay=5, template=template)
+    network.stimulate(0, start=5, number=1, weight=0.04, delay=1)
+    record = [('dend', x) for x in dend_locations] + [('soma', 0.5)]
+    results = network.simulate(simdur, record=record)
+    return results.times, results.V_m[0, :-1], results.V_m[:, -1]
 
-syns    = [h.ExpSyn(cells[1]['dend'](0.5)), h.ExpSyn(cells[2]['dend'](0.5))]
-netcons = [h.NetCon(cells[0]['soma'](0.5)._ref_v, syns[0], sec=cells[0]['soma']), 
-           h.NetCon(cells[1]['soma'](0.5)._ref_v, syns[1], sec=cells[1]['soma'])]
 
-for netcon in netcons:
-    netcon.weight[0] = 0.04
-    netcon.delay = 5
+def simulate_neuron():
+    from neuron import h
+    h.load_file('stdrun.hoc')
 
-syn_ = h.ExpSyn(cells[0]['dend'](0.5))
+    # Model creation
 
+    cells = {}
 
-# Stimulation
+    for i in range(n_cells):
 
-stim = h.NetStim()
-stim.number = 1
-stim.start = 5
-ncstim = h.NetCon(stim, syn_)
-ncstim.delay = 1
-ncstim.weight[0] = 0.04
-stim_amp_array = [0.08]
+        soma = h.Section(name='soma')
+        soma.L = soma.diam = 12.6157    # [um]
+        soma.Ra = 100                   # Axial resistance [Ohm * cm]
+        soma.cm = 1                     # Membrane capacitance [uF / cm^2]
+        soma.insert('hh')               # Insert active Hodgkin-Huxley current in the soma
+        soma.gnabar_hh = 0.12           # Sodium conductance [S / cm2]
+        soma.gkbar_hh = 0.036           # Potassium conductance [S / cm2]
+        soma.gl_hh = 0.0003             # Leak conductance [S / cm2]
+        soma.el_hh = -54.3              # Reversal potential [mV]
 
+        dend = h.Section(name='dend')
+        dend.L = 200                    # [um]
+        dend.nseg = 101
+        dend.Ra = 100                   # Axial resistance [Ohm * cm]
+        dend.cm = 1                     # Membrane capacitance [uF / cm^2]
+        dend.diam = 1                   # [um]
+        dend.insert('pas')              # Insert passive current in the dendrite
+        dend.g_pas = 0.001              # Passive conductance [S / cm2]
+        dend.e_pas = -65                # Leak reversal potential [mV]
+        dend.connect(soma(1))
 
-# Recording vectors
+        cells[i] = {'soma': soma, 'dend': dend}
 
-t_vec = h.Vector() 
-t_vec.record(h._ref_t)
+    syns    = [h.ExpSyn(cells[i]['dend'](0.5)) for i in range(1, n_cells)]
+    netcons = [h.NetCon(cells[i]['soma'](0.5)._ref_v, syns[i], sec=cells[i]['soma']) for i in range(n_cells - 1)]
 
-for cell in cells:
-    cells[cell]['soma_Vm'] = h.Vector()
-    cells[cell]['soma_Vm'].record(cells[cell]['soma'](0.5)._ref_v)
+    for netcon in netcons:
+        netcon.weight[0] = 0.04
+        netcon.delay = 5
 
-dend_v_vec_array = []
-string_array     = []
+    syn_ = h.ExpSyn(cells[0]['dend'](0.5))
 
-for i in np.flip(np.linspace(0, dend.L, 6)):
-    dend_v_vec = h.Vector()
-    percent = 100 * (i / cells[0]['dend'].L)
-    string_array.append(f'{percent} %')
-    dend_v_vec.record(cells[0]['dend'](i/cells[0]['dend'].L)._ref_v)
-    dend_v_vec_array.append(dend_v_vec)
 
+    # Stimulation
 
-# Simulation parameters
+    stim = h.NetStim()
+    stim.number = 1
+    stim.start = 5
+    ncstim = h.NetCon(stim, syn_)
+    ncstim.delay = 1
+    ncstim.weight[0] = 0.04
 
-simdur = 40
-h.tstop = simdur 
 
+    # Recording vectors
+
+    t_vec = h.Vector()
+    t_vec.record(h._ref_t)
+
+    for cell in cells:
+        cells[cell]['soma_Vm'] = h.Vector()
+        cells[cell]['soma_Vm'].record(cells[cell]['soma'](0.5)._ref_v)
+
+    dend_v_vec_array = []
+    for x in dend_locations:
+        dend_v_vec = h.Vector()
+        dend_v_vec.record(cells[0]['dend'](x)._ref_v)
+        dend_v_vec_array.append(dend_v_vec)
+
+
+    # run simulation
+
+    h.tstop = simdur
+    h.run()
+
+    results = (np.array(t_vec), np.array(dend_v_vec_array), np.array([cells[cell]['soma_Vm'] for cell in cells]))
+    h("forall {delete_section()}")
+    return results
 
-# run simulation
 
-h.run()
+# Simulated with the native solver, or with NEURON when run with --neuron. Worker processes import this script, so
+# it only runs as the main module
+if __name__ == '__main__':
+    simulate = simulate_neuron if len(sys.argv) > 1 and sys.argv[1] == '--neuron' else simulate_native
+    t_vec, dend_v_vec_array, soma_Vm = simulate()
 
 
-# Plot
+    # Plot
 
-cmap = plt.get_cmap('Blues')   
-colors = cmap(np.linspace(0, 1, len(dend_v_vec_array) * 2))
-plt.figure(figsize=(8, 4)) 
+    cmap = plt.get_cmap('Blues')
+    colors = cmap(np.linspace(0, 1, len(dend_v_vec_array) * 2))
+    plt.figure(figsize=(8, 4))
 
-plt.plot(t_vec, dend_v_vec_array[0], linewidth=3, color=colors[-1]) 
-for i, vec in enumerate(dend_v_vec_array[1:]):
-    plt.plot(t_vec, vec, color = colors[len(colors)-2-i]) 
+    plt.plot(t_vec, dend_v_vec_array[0], linewidth=3, color=colors[-1])
+    for i, vec in enumerate(dend_v_vec_array[1:]):
+        plt.plot(t_vec, vec, color = colors[len(colors)-2-i])
 
-plt.plot(t_vec, cells[0]['soma_Vm'], label='soma @ cell 1', color='red', linewidth=3)
-plt.plot(t_vec, cells[1]['soma_Vm'], label='soma @ cell 2', color='green', linewidth=3)
-plt.plot(t_vec, cells[2]['soma_Vm'], label='soma @ cell 3', color='orange', linewidth=3)
-plt.title("Compartmental Model", fontsize=15)
-plt.xlabel('Time (ms)', fontsize=15) 
-plt.ylabel("Membrane Potential (mV)", fontsize=15) 
-plt.legend()
-plt.show()
-    
-h("forall {delete_section()}")
+    for i, color in enumerate(['red', 'green', 'orange'][:n_cells]):
+        plt.plot(t_vec, soma_Vm[i], label=f'soma @ cell {i + 1}', color=color, linewidth=3)
+    plt.title("Compartmental Model", fontsize=15)
+    plt.xlabel('Time (ms)', fontsize=15)
+    plt.ylabel("Membrane Potential (mV)", fontsize=15)
+    plt.legend()
+    plt.show()
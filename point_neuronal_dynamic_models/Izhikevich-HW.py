@@ -1,10 +1,22 @@
+import os
 import sys
 import re
+import time
+import warnings
 import numpy as np
-import matplotlib.pyplot as plt
 
+from collections import OrderedDict
 from dataclasses import dataclass
 
+from checkpoint import Checkpoint
+from figure_jobs import INLINE, FigureJob, FigureRenderer
+from stimulus_protocols import Protocol
+
+try:
+    import numba
+except ImportError:  # The compiled backend is optional
+    numba = None
+
 
 @dataclass
 class IzhikevichParams:
@@ -17,9 +29,138 @@ class IzhikevichParams:
         return tuple(vars(self).values())
 
 
+@dataclass
+class IzhikevichParamsArray:
+    """
+    Structure-of-arrays counterpart of IzhikevichParams, holding the a, b, c, and d parameters of a population of
+    cells as four arrays of shape (n_cells,).
+    """
+    a: np.ndarray
+    b: np.ndarray
+    c: np.ndarray
+    d: np.ndarray
+
+    def __post_init__(self) -> None:
+        self.a, self.b, self.c, self.d = (np.asarray(x, dtype=float) for x in np.broadcast_arrays(*self.as_tuple()))
+        assert self.a.ndim == 1, 'Parameters must be scalars or one-dimensional arrays'
+
+    def __len__(self) -> int:
+        return len(self.a)
+
+    @classmethod
+    def from_params(cls, params: list) -> 'IzhikevichParamsArray':
+        return cls(*np.array([p.as_tuple() for p in params], dtype=float).T)
+
+    @classmethod
+    def from_grid(cls, a: np.ndarray, b: np.ndarray, c: np.ndarray, d: np.ndarray) -> 'IzhikevichParamsArray':
+        """
+        Creates a population with one cell per point of the Cartesian product of the given parameter values.
+        """
+        return cls(*(axis.ravel() for axis in np.meshgrid(a, b, c, d, indexing='ij')))
+
+    def as_tuple(self):
+        return self.a, self.b, self.c, self.d
+
+    def __getitem__(self, index: int) -> IzhikevichParams:
+        return IzhikevichParams(*(float(x[index]) for x in self.as_tuple()))
+
+
+def _simulate_kernel(a: float, b: float, c: float, d: float, v: float, u: float, v_apex: float, dt: float,
+                     stimulus: np.ndarray, trace: np.ndarray, start: int, stop: int) -> tuple:
+    """
+    Integrates the v and u equations over the stimulus from index start to stop, writing into the given (2, N) trace
+    array in place, and returns the final v and u. v represents the membrane potential in mV, and u the membrane
+    recovery variable.
+    This function is shared by the Python backend and, when Numba is installed, is JIT-compiled for the Numba backend.
+    v ** 2 is written as v * v, since NumPy's scalar power is not always correctly rounded, unlike the compiled product.
+    """
+    for i in range(start, stop):
+        v += dt * (0.04 * (v * v) + 5 * v + 140 - u + stimulus[i])
+        u += dt * a * (b * v - u)
+        if v > v_apex:
+            trace[0, i] = v_apex
+            v = c
+            u += d
+        else:
+            trace[0, i] = v
+            trace[1, i] = u
+    return v, u
+
+
+# Numba compiles lazily, on the first call with the Numba backend
+_compiled_simulate_kernel = numba.njit(cache=True)(_simulate_kernel) if numba is not None else None
+
+BACKENDS = ('python', 'numba')
+
+
+# The rest cache of main, in the user's cache directory, out of the source tree and of the working directory
+REST_CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                               'neuronal_dynamics', 'izhikevich_rest_states.npz')
+
+
+class RestStateCache:
+    """
+    Memoizes the v and u that Izhikevich simulations settle to by the end of their stabilization period, under a
+    constant pre-stimulus current, so that simulations resume from start_idx instead of integrating the stabilization
+    again. Entries are keyed on (a, b, c, d, v_0, dt, pre-stimulus level), along with the spike apex and the number of
+    stabilization steps, which determine the settled state as well. The least recently used entries are evicted
+    beyond maxsize, and the cache is persisted to an NPZ file when a path is given, loaded on creation and written
+    by save.
+    """
+
+    def __init__(self, maxsize: int = 4096, path: str = None) -> None:
+        """
+        Initializes the cache.
+
+        Args:
+            maxsize (int): Maximal number of cached states
+            path (str): NPZ file the cache is loaded from, if it exists, and saved to
+        """
+        assert maxsize >= 1, 'The cache must hold at least one state'
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._states = OrderedDict()
+        if path is not None and os.path.exists(path):
+            with np.load(path) as data:
+                for key, state in zip(data['keys'].tolist(), data['states']):
+                    self.put(tuple(key), state)
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def get(self, key: tuple) -> np.ndarray:
+        state = self._states.get(key)
+        if state is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._states.move_to_end(key)
+        return state
+
+    def put(self, key: tuple, state: np.ndarray) -> None:
+        self._states[key] = np.array(state, dtype=float)
+        self._states.move_to_end(key)
+        while len(self._states) > self.maxsize:
+            self._states.popitem(last=False)
+
+    def clear(self) -> None:
+        self._states.clear()
+
+    def save(self, path: str = None) -> None:
+        path = path or self.path
+        assert path is not None, 'No path to save the cache to'
+        keys = np.array(list(self._states), dtype=float).reshape(-1, 9)
+        states = np.array(list(self._states.values()), dtype=float).reshape(-1, 2)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        np.savez(path, keys=keys, states=states)
+
+
 class IzhikevichModel:
 
-    def __init__(self, T: float, dt: float, v_0: float = -70, v_apex: float = 30, stabilization_time: float = 100) -> None:
+    def __init__(self, T: float, dt: float, v_0: float = -70, v_apex: float = 30, stabilization_time: float = 100,
+                 rest_cache: RestStateCache = None) -> None:
         """
         Initializes the Izhikevich model with the given parameters.
 
@@ -30,11 +171,14 @@ class IzhikevichModel:
             v_spike_apex (float): Spike voltage apex                        [mV]
             stimulus (np.ndarray): Stimulus current intensities             [Array of Amperes]
             stabilization_time (float): model voltage stabilization time    [milliseconds]
+            rest_cache (RestStateCache): Cache of stabilized states, which simulations resume from when given
         """
         assert T >= 0 and stabilization_time >= 0, 'times cannot be negative'
         self.set_time(T, dt, stabilization_time)
         self.v_0 = v_0
         self.v_spike_apex = v_apex
+        self.rest_cache = rest_cache
+        self.last_state = None  # Checkpoint at the end of the last simulation
 
     @property
     def times(self):
@@ -49,37 +193,182 @@ class IzhikevichModel:
         self._dt = dt
         self.start_idx = int(stabilization_time / self._dt)  # Experiment start time by index, after model stabilization
 
-    def simulate(self, params: IzhikevichParams, stimulus: np.ndarray) -> np.ndarray:
+    def _sample(self, stimulus) -> np.ndarray:
+        """
+        Samples a stimulus protocol at the model's times, as the simulation kernels step through whole arrays.
+        """
+        return stimulus(self.times) if isinstance(stimulus, Protocol) else np.asarray(stimulus, dtype=float)
+
+    def _sample_batch(self, stimuli, n_cells: int) -> np.ndarray:
         """
-        Simulates the Izhikevich model with the given parameters and input stimulus currents.
+        Samples shared or per-cell stimuli, any of which may be a protocol, into an array of shape (n_cells, N).
+        """
+        if isinstance(stimuli, Protocol) or (not isinstance(stimuli, np.ndarray) and any(isinstance(s, Protocol) for s in stimuli)):
+            stimuli = self._sample(stimuli) if isinstance(stimuli, Protocol) else np.stack([self._sample(s) for s in stimuli])
+        stimuli = np.asarray(stimuli, dtype=float)
+        if stimuli.ndim == 1:
+            stimuli = np.broadcast_to(stimuli, (n_cells, len(stimuli)))
+        assert stimuli.shape[0] == n_cells, 'stimuli must be shared or given per cell'
+        return stimuli
+
+    def _step_batch(self, a: np.ndarray, b: np.ndarray, c: np.ndarray, d: np.ndarray, v: np.ndarray, u: np.ndarray,
+                    stimuli: np.ndarray, start: int, stop: int, traces: np.ndarray = None) -> tuple:
+        """
+        Steps every cell from start to stop, where stimuli[i] holds the currents of step i, tracing into the
+        time-major traces when given, and returns the final v and u.
+        """
+        for i in range(start, stop):
+            I = stimuli[i]
+            v += self.dt * (0.04 * (v * v) + 5 * v + 140 - u + I)
+            u += self.dt * a * (b * v - u)
+
+            # Spiking cells trace the apex and are reset, the recovery trace is left untouched like in simulate
+            spiked = v > self.v_spike_apex
+            if traces is not None:
+                traces[i, 0] = np.where(spiked, self.v_spike_apex, v)
+                traces[i, 1] = np.where(spiked, 0, u)
+            v = np.where(spiked, c, v)
+            u = np.where(spiked, u + d, u)
+        return v, u
+
+    def rest_states(self, params: IzhikevichParamsArray, v0s: np.ndarray, levels: np.ndarray) -> np.ndarray:
+        """
+        Returns v and u of every cell at start_idx, after settling from its v_0 under a constant pre-stimulus level,
+        as an array of shape (2, n_cells). States are looked up in the rest cache, and the cells that miss it are
+        settled together, and cached.
+        """
+        n_cells = len(params)
+        v0s = np.broadcast_to(np.asarray(v0s, dtype=float), (n_cells,))
+        levels = np.broadcast_to(np.asarray(levels, dtype=float), (n_cells,))
+        keys = [(*params[i].as_tuple(), float(v0s[i]), float(self.dt), float(levels[i]), float(self.v_spike_apex),
+                 float(self.start_idx)) for i in range(n_cells)]
+
+        states = np.empty((2, n_cells))
+        missing = []
+        for i, key in enumerate(keys):
+            state = self.rest_cache.get(key) if self.rest_cache is not None else None
+            if state is None:
+                missing.append(i)
+            else:
+                states[:, i] = state
+
+        if missing:
+            a, b, c, d = (x[missing] for x in params.as_tuple())
+            v = v0s[missing].copy()
+            stimuli = np.broadcast_to(levels[missing], (self.start_idx, len(missing)))
+            states[:, missing] = self._step_batch(a, b, c, d, v, b * v, stimuli, 0, self.start_idx)
+            if self.rest_cache is not None:
+                for i in missing:
+                    self.rest_cache.put(keys[i], states[:, i])
+        return states
+
+    def _cached_rest(self, params: IzhikevichParamsArray, v0s: np.ndarray, stimuli: np.ndarray,
+                     stop_idx: int) -> Checkpoint:
+        # Returns the checkpoint to resume a simulation from at start_idx, when the rest cache applies to it
+        if self.rest_cache is None or self.start_idx == 0 or (stop_idx is not None and stop_idx < self.start_idx):
+            return None
+        pre_stimulus = stimuli[..., :self.start_idx]
+        levels = pre_stimulus[..., 0]
+        if not np.all(pre_stimulus == levels[..., np.newaxis]):
+            return None
+        states = self.rest_states(params, v0s, levels)
+        return Checkpoint(type(self).__name__, self.start_idx, states if np.ndim(levels) else states[:, 0])
+
+    def _span(self, initial_state: Checkpoint, stop_idx: int, n_cells: int = None) -> tuple:
+        # Returns the first and last time step indices and the initial v and u of a simulation
+        stop_idx = len(self.times) if stop_idx is None else stop_idx
+        if initial_state is None:
+            return 0, stop_idx, None
+        initial_state.expect(type(self).__name__)
+        shape = (2,) if n_cells is None else (2, n_cells)
+        assert initial_state.state.shape == shape, f'Expected a checkpoint state of shape {shape}'
+        assert initial_state.step <= stop_idx, 'The checkpoint is past the end of the simulation'
+        return initial_state.step, stop_idx, initial_state.state
+
+    def simulate(self, params: IzhikevichParams, stimulus: np.ndarray, backend: str = 'python',
+                 initial_state: Checkpoint = None, stop_idx: int = None) -> np.ndarray:
+        """
+        Simulates the Izhikevich model with the given parameters and input stimulus currents. The simulation can stop
+        early at stop_idx and be resumed later from self.last_state, its final checkpoint, which holds v, u and the
+        index of the next time step. Resuming from the state at self.start_idx skips the stabilization, which is done
+        automatically with a rest cache, when the stimulus is constant before start_idx; the stabilization traces are
+        then left at zero.
 
         Args:
             params (IzhikevichParams): simulation a, b, c, and d parameters
-            stimulus (np.ndarray): Stimulus current intensities [Array of Amperes]
+            stimulus (np.ndarray): Stimulus current intensities [Array of Amperes], or a Protocol evaluated at self.times
+            backend (str): 'python' for the interpreted loop, or 'numba' for the JIT-compiled loop. The Numba backend
+                           falls back to the Python loop when Numba is not installed, and both return identical traces.
+            initial_state (Checkpoint): State to resume from, instead of starting at rest from v_0 at the first step
+            stop_idx (int): Index of the time step to stop before, defaults to the end of self.times
 
         Returns:
-            trace (np.ndarray): Tracing du and dv
+            trace (np.ndarray): Tracing du and dv, left at zero outside the simulated steps
         """
+        assert backend in BACKENDS, f'backend must be one of {BACKENDS}'
         a, b, c, d = params.as_tuple()
+        stimulus = self._sample(stimulus)
+        if initial_state is None:
+            initial_state = self._cached_rest(IzhikevichParamsArray.from_params([params]), self.v_0, stimulus, stop_idx)
+        start, stop, state = self._span(initial_state, stop_idx)
+        v, u = (float(self.v_0), b * float(self.v_0)) if state is None else state.tolist()
 
         trace = np.zeros((2, len(self.times)))  # For tracing du and dv
-        v  = self.v_0                           # v represents the memory potential in mV
-        u  = b * v                              # u represents the membrane recovery variable
 
-        for i, I in enumerate(stimulus):
-            v += self.dt * (0.04 * v ** 2 + 5 * v + 140 - u + I)
-            u += self.dt * a * (b * v - u)
-            if v > self.v_spike_apex:
-                trace[0, i] = self.v_spike_apex
-                v = c
-                u += d
+        kernel = _simulate_kernel
+        if backend == 'numba':
+            if _compiled_simulate_kernel is not None:
+                kernel = _compiled_simulate_kernel
             else:
-                trace[0, i] = v
-                trace[1, i] = u
+                warnings.warn('Numba is not installed, falling back to the Python backend')
 
+        v, u = kernel(float(a), float(b), float(c), float(d), float(v), float(u), float(self.v_spike_apex),
+                      float(self.dt), stimulus, trace, start, stop)
+        self.last_state = Checkpoint(type(self).__name__, stop, [v, u])
         return trace
 
-    def plot(self, title: str, stimulus: np.ndarray, trace: np.ndarray, savefig: bool = False) -> None:
+    def simulate_batch(self, params: IzhikevichParamsArray, stimuli: np.ndarray, v0s: np.ndarray = None,
+                       initial_state: Checkpoint = None, stop_idx: int = None) -> np.ndarray:
+        """
+        Simulates a population of independent cells at once, stepping all of them with vectorized NumPy operations.
+        Each cell's trace is identical to the one returned by simulate for the same parameters, stimulus and v_0.
+        Like simulate, it can stop at stop_idx and resume from initial_state, with v and u of shape (2, n_cells), and
+        skips the stabilization with a rest cache.
+
+        Args:
+            params (IzhikevichParamsArray): a, b, c, and d parameters of every cell
+            stimuli (np.ndarray): Stimulus current intensities, either shared (N,) or per cell (n_cells, N), where
+                                  protocols may stand for any of the stimuli
+            v0s (np.ndarray): Membrane resting potential of every cell, a scalar or (n_cells,). Defaults to self.v_0
+            initial_state (Checkpoint): State to resume from, such as the last_state of a previous batch
+            stop_idx (int): Index of the time step to stop before, defaults to the end of self.times
+
+        Returns:
+            traces (np.ndarray): Tracing du and dv of every cell, of shape (n_cells, 2, len(self.times))
+        """
+        n_cells = len(params)
+        a, b, c, d = params.as_tuple()
+        stimuli = self._sample_batch(stimuli, n_cells)
+        v0s = np.broadcast_to(np.asarray(self.v_0 if v0s is None else v0s, dtype=float), (n_cells,))
+        if initial_state is None:
+            initial_state = self._cached_rest(params, v0s, stimuli, stop_idx)
+        stimuli = np.ascontiguousarray(stimuli.T)  # Time-major, so every step reads a contiguous row
+
+        # Traces are filled time-major as well, and transposed once at the end
+        traces = np.zeros((len(self.times), 2, n_cells))
+        start, stop, state = self._span(initial_state, stop_idx, n_cells)
+        if state is None:
+            v = v0s.copy()
+            u = b * v
+        else:
+            v, u = state.copy()
+        v, u = self._step_batch(a, b, c, d, v, u, stimuli, start, stop, traces)
+
+        self.last_state = Checkpoint(type(self).__name__, stop, [v, u])
+        return np.ascontiguousarray(traces.transpose(2, 1, 0))
+
+    def plot(self, title: str, stimulus: np.ndarray, trace: np.ndarray, savefig: bool = False,
+             renderer: FigureRenderer = None) -> None:
         """
         Plots the membrane potential over time as simulated by the model, using the given simulation trace and stimulus.
 
@@ -88,6 +377,7 @@ class IzhikevichModel:
             stimulus (np.ndarray): The simulation input stimulus current array.
             trace (np.ndarray): The simulation result's trace array, which contains the v and u values over time.
             savefig (bool): Whether to save the plot to a file.
+            renderer (FigureRenderer): Renders the figure, in this process by default, or in a worker pool, or not at all.
 
         Raises:
             ValueError: If the shapes of the stimulus and trace arrays are incompatible.
@@ -96,26 +386,69 @@ class IzhikevichModel:
             The trace array should have shape (2, N), where N is the number of time steps, with the first row
             representing the values of membrane potential and the second row representing the values of the recovery variable.
         """
-        plt.figure(figsize=(10, 5))
-        plt.title(f'Izhikevich Model: {title}', fontsize=15) 
-        plt.ylabel('Membrane Potential (mV)', fontsize=15) 
-        plt.xlabel('Time (msec)', fontsize=15)
-        plt.plot(self.times[self.start_idx:], trace[0][self.start_idx:], linewidth=2, label='Vm')
-        plt.plot(self.times[self.start_idx:], trace[1][self.start_idx:], linewidth=2, label='Recovery', color='green')
-        plt.plot(self.times[self.start_idx:], (stimulus + self.v_0)[self.start_idx:], label='Stimuli (Scaled)', color='sandybrown', linewidth=2)
-        plt.legend(loc=1)
+        renderer = renderer or INLINE
+        if renderer.mode == 'none':
+            return
+
+        path = None
         if savefig:
             clean_title = re.sub(r'\s*\([^()]*\)\s*', '', title).replace(' ', '_').replace('-', '_')
-            plt.savefig(fname=clean_title + '.png')
-        else:
-            plt.show()
+            path = clean_title + '.png'
+        job = FigureJob(f'Izhikevich Model: {title}', path, xlabel='Time (msec)', ylabel='Membrane Potential (mV)')
+        stimulus = self._sample(stimulus)
+        job.plot(self.times[self.start_idx:], trace[0][self.start_idx:], linewidth=2, label='Vm')
+        job.plot(self.times[self.start_idx:], trace[1][self.start_idx:], linewidth=2, label='Recovery', color='green')
+        job.plot(self.times[self.start_idx:], (stimulus + self.v_0)[self.start_idx:], label='Stimuli (Scaled)', color='sandybrown', linewidth=2)
+        renderer.submit(job)
+
+
+def benchmark_backends(durations: tuple = (100, 1000, 10000, 100000), dt: float = 0.01, repeats: int = 3) -> None:
+    """
+    Reports the speedup of the Numba backend over the Python backend across trace lengths, using the Regular Spiking
+    parameters and a step stimulus. The compilation time is excluded by a warm-up run.
+
+    Args:
+        durations (tuple): Simulated experiment durations to benchmark         [milliseconds]
+        dt (float): Simulation time interval                                    [milliseconds]
+        repeats (int): Number of timed runs per backend, of which the best is reported
+    """
+    if _compiled_simulate_kernel is None:
+        print('Numba is not installed, nothing to benchmark')
+        return
+
+    params = IzhikevichParams(a=0.02, b=0.2, c=-65, d=8)
+    print(f"{'steps':>10} {'python [s]':>12} {'numba [s]':>12} {'speedup':>10}  identical")
+    for T in durations:
+        izhikevich = IzhikevichModel(T=T, dt=dt)
+        stimulus = np.zeros(len(izhikevich.times))
+        stimulus[izhikevich.start_idx:] = 10
+        izhikevich.simulate(params, stimulus[:10], backend='numba')  # Warm-up, triggers the compilation
+
+        best = {}
+        traces = {}
+        for backend in BACKENDS:
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                traces[backend] = izhikevich.simulate(params, stimulus, backend=backend)
+                timings.append(time.perf_counter() - start)
+            best[backend] = min(timings)
+
+        identical = np.array_equal(traces['python'], traces['numba'])
+        speedup = best['python'] / best['numba']
+        print(f"{len(stimulus):>10} {best['python']:>12.5f} {best['numba']:>12.5f} {speedup:>9.1f}x  {identical}")
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark':
+        benchmark_backends()
+        return
+
     savefig = len(sys.argv) > 1 and sys.argv[1] == '--savefig'
+    no_plots = len(sys.argv) > 1 and sys.argv[1] == '--no-plots'
 
-    # Instantiate an Izhikevich model
-    izhikevich = IzhikevichModel(T=200, dt=0.1)
+    # Instantiate an Izhikevich model, whose stabilized states are cached across runs
+    izhikevich = IzhikevichModel(T=200, dt=0.1, rest_cache=RestStateCache(path=REST_CACHE_PATH))
 
     # Define stimulus as a step function
     step_stimulus = np.zeros(len(izhikevich.times))
@@ -142,11 +475,14 @@ def main():
         ('Thalamo-Cortical (TC) - Neg',  -87,  IzhikevichParams(a=0.02, b=0.25, c=-65, d=0.05),  neg_step_stimulus)
     ]
 
-    # Simulate and plot each experiment
-    for title, v_0, params, stimulus in experiments:
-        izhikevich.v_0 = v_0
-        trace = izhikevich.simulate(params, stimulus)
-        izhikevich.plot(title, stimulus, trace, savefig)
+    # Simulate all experiments at once, and plot each of them
+    titles, v0s, params, stimuli = zip(*experiments)
+    traces = izhikevich.simulate_batch(IzhikevichParamsArray.from_params(params), np.stack(stimuli), np.array(v0s))
+    izhikevich.rest_cache.save()
+    with FigureRenderer('none' if no_plots else 'pool') as renderer:
+        for title, v_0, stimulus, trace in zip(titles, v0s, stimuli, traces):
+            izhikevich.v_0 = v_0
+            izhikevich.plot(title, stimulus, trace, savefig, renderer)
 
 
 if __name__ == '__main__':
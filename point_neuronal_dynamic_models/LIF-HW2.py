@@ -1,6 +1,10 @@
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 
+from spike_rate import SpikeRateEstimator
+from trace_recorder import TraceRecorder
+
 # Model Parameters
 sim_time = 50 * 1e-3                    # Simulation time          [seconds]
 dt = 0.1 * 1e-3                         # Simulation time interval [seconds]
@@ -11,6 +15,8 @@ tau_ref = 1 * 1e-3                      # Refractory Period        [seconds]
 V_spike = 50 * 1e-3                     # Spike voltage            [V]
 T = np.arange(0, sim_time + dt, dt)     # Time array               [list of seconds]
 
+dump_trace = len(sys.argv) > 1 and sys.argv[1] == '--dump-trace'
+
 # Define the stimulus as a list of 'flat' current inputs
 I = np.array([1e-04] * len(T))
 
@@ -30,8 +36,11 @@ for V_th_mV in [-70, -30, 10]:
     V_m = np.ones(len(T)) * V_rest      # Membrane voltage array   [list of V]
     V_th = V_th_mV * 1e-3               # Spike threshold          [V]
     tau = R_m * C_m                     # Membrane time constant   [seconds]
-    spikes = []                         # Spikes timings           [list of milliseconds]
-    F = [0]                             # Frequencies              [list of Hz]
+    spiked_steps = np.zeros(len(T), dtype=bool)  # Spike indicators   [list of bool]
+    rate = SpikeRateEstimator()         # Streaming spike rate     [timings in milliseconds]
+    F = np.zeros(len(T))                # Frequencies              [list of Hz]
+    trace = TraceRecorder({'step': int, 't': float, 'f': float, 'I': float, 'u_inf': float, 'u_now': float, 'spiked': bool},
+                          n_steps=len(T) - 1)   # Step diagnostics [t in ms, f in Hz, I in uA, u_inf and u_now in V]
 
     # Simulation:
     for i, t in enumerate(T[:-1]):
@@ -41,21 +50,22 @@ for V_th_mV in [-70, -30, 10]:
             V_m[i + 1] = V_m_inf_i + (V_m[i] - V_m_inf_i) * np.exp(-dt / tau)
             if V_m[i] >= V_th:
                 spiked = True
-                spikes.append(t * 1e3)
+                spiked_steps[i] = True
                 V_m[i] = V_spike
                 t_init = t + tau_ref
     
         # Calculate frequency as 1 divided by time-cycle, where the time-cycle is defined as the time between spikes]
-        freq = 1 / (spikes[-1] - spikes[-2]) if len(spikes) > 1 else 0
-        F.append(freq) 
+        rate.update(t * 1e3, spiked)
+        freq = rate.last_isi_rate
+        F[i + 1] = freq
 
-        msg = f"step={i}, t={t * 1e+3} ms, f={freq} Hz, I(t)={I[i] * 1e+6} uA, u_inf={(V_rest + R_m * I[i])} V, u_now={V_m[i]} V"
-        if spiked:
-            msg += ", SPIKED!"
+        trace.record(i, i, t * 1e+3, freq, I[i] * 1e+6, V_rest + R_m * I[i], V_m[i], spiked)
 
-        print(msg)
+    if dump_trace:
+        trace.to_csv(f'LIF_trace_V_th={V_th_mV}.csv')
 
     # Plot simulation results
+    spikes = T[spiked_steps] * 1e3      # Spikes timings           [list of milliseconds]
     plt.figure(figsize=(10, 5))
     plt.title(f'Leaky Integrate-and-Fire Model (V_th={V_th} V)', fontsize=15) 
     plt.ylabel('Membrane Potential (mV)', fontsize=15) 
@@ -0,0 +1,192 @@
+import math
+import bisect
+import numpy as np
+
+from dataclasses import dataclass
+
+from stimulus_protocols import Protocol
+
+
+@dataclass
+class LifParams:
+    """
+    Leaky Integrate-and-Fire model parameters. Every parameter may be a scalar or an array, in which case the model
+    is evaluated for all of the parameter values at once, following NumPy broadcasting rules.
+    """
+    R_m: float = 1 * 1e3            # Membrane Resistance      [Ohm]
+    C_m: float = 5 * 1e-6           # Membrane Capacitance     [F]
+    V_rest: float = -70 * 1e-3      # Resting potential        [V]
+    V_th: float = -40 * 1e-3        # Spike threshold          [V]
+    V_spike: float = 50 * 1e-3      # Spike voltage            [V]
+    tau_ref: float = 1 * 1e-3       # Refractory Period        [seconds]
+
+    @property
+    def tau(self):
+        return self.R_m * self.C_m  # Membrane time constant   [seconds]
+
+    def steady_state_voltage(self, I: np.ndarray) -> np.ndarray:
+        return self.V_rest + self.R_m * I
+
+
+@dataclass
+class LifResults:
+    times: np.ndarray               # Time array               [seconds]
+    V_m: np.ndarray                 # Membrane voltages        [V], of shape (..., len(times))
+    spikes: np.ndarray              # Spike indicators         [bool], of shape (..., len(times))
+
+    def spike_times(self, index: tuple = ()) -> np.ndarray:
+        return self.times[self.spikes[index]]
+
+
+def firing_rate(I: np.ndarray, params: LifParams) -> np.ndarray:
+    """
+    Computes the steady-state firing rate under a constant input current in closed form, without time stepping.
+    Starting from V_rest, the membrane reaches V_th after tau * ln((V_inf - V_rest) / (V_inf - V_th)), and then rests
+    for tau_ref, so the rate is the inverse of their sum when V_inf > V_th, and zero otherwise.
+
+    Args:
+        I (np.ndarray): Constant stimulus current intensities   [Amperes]
+        params (LifParams): Model parameters, broadcast against I
+
+    Returns:
+        rate (np.ndarray): Firing rates                        [Hz]
+    """
+    V_inf = params.steady_state_voltage(np.asarray(I, dtype=float))
+    fires = V_inf > params.V_th
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # A threshold below V_rest is crossed right after the refractory period, hence the clipping at zero
+        time_to_threshold = params.tau * np.log(np.maximum((V_inf - params.V_rest) / (V_inf - params.V_th), 1))
+        rate = 1 / (params.tau_ref + time_to_threshold)
+    return np.where(fires, rate, 0.0)
+
+
+def simulate(stimulus: np.ndarray, dt: float, params: LifParams, point_count: int = None) -> LifResults:
+    """
+    Simulates the model under a time-varying stimulus with exact exponential integration, assuming the current is
+    constant within each time step. The decay factor exp(-dt / tau) is computed once, and all leading dimensions of
+    the stimulus and the parameters are simulated together.
+
+    Args:
+        stimulus (np.ndarray): Stimulus current intensities, of shape (..., T)   [Amperes], or a Protocol
+        dt (float): Simulation time interval                                    [seconds]
+        params (LifParams): Model parameters, broadcast against stimulus[..., 0]
+        point_count (int): Number of samples T, required when the stimulus is a Protocol
+
+    Returns:
+        results (LifResults): The times, membrane voltages and spike indicators
+    """
+    if isinstance(stimulus, Protocol):
+        assert point_count is not None, 'Protocol stimuli require a point_count'
+        stimulus = stimulus.sample(point_count, dt)
+    stimulus = np.asarray(stimulus, dtype=float)
+    shape = np.broadcast_shapes(stimulus.shape[:-1], *(np.shape(x) for x in vars(params).values()))
+    point_count = stimulus.shape[-1]
+    stimulus = np.broadcast_to(stimulus, shape + (point_count,))
+
+    decay = np.exp(-dt / params.tau)
+    refractory_steps = np.broadcast_to(np.round(np.asarray(params.tau_ref) / dt).astype(int), shape)
+
+    V_m = np.empty(shape + (point_count,))
+    spikes = np.zeros(shape + (point_count,), dtype=bool)
+    V = np.broadcast_to(np.asarray(params.V_rest, dtype=float), shape).copy()
+    refractory = np.zeros(shape, dtype=int)  # Remaining refractory steps
+
+    V_m[..., 0] = V
+    for i in range(1, point_count):
+        V_inf = params.steady_state_voltage(stimulus[..., i - 1])
+        active = refractory == 0
+        V = np.where(active, V_inf + (V - V_inf) * decay, V)
+        refractory = np.maximum(refractory - 1, 0)
+
+        # Threshold crossings emit a spike, reset to V_rest and start a refractory period
+        spiked = active & (V >= params.V_th)
+        spikes[..., i] = spiked
+        V_m[..., i] = np.where(spiked, params.V_spike, V)
+        V = np.where(spiked, params.V_rest, V)
+        refractory = np.where(spiked, refractory_steps, refractory)
+
+    return LifResults(np.arange(point_count) * dt, V_m, spikes)
+
+
+@dataclass
+class LifEventResults:
+    spike_times: np.ndarray         # Spike timings            [seconds]
+    times: np.ndarray = None        # Resampled time array     [seconds], when requested
+    V_m: np.ndarray = None          # Resampled voltages       [V], when requested
+
+
+def piecewise_constant(stimulus: np.ndarray, dt: float) -> tuple:
+    """
+    Compresses a densely sampled stimulus into the times at which it changes and the current from each change onward.
+    """
+    stimulus = np.asarray(stimulus, dtype=float)
+    change_idx = np.concatenate(([0], np.flatnonzero(np.diff(stimulus)) + 1))
+    return change_idx * dt, stimulus[change_idx]
+
+
+def simulate_event_driven(change_times: np.ndarray, currents: np.ndarray, sim_time: float, params: LifParams,
+                          dt: float = None) -> LifEventResults:
+    """
+    Simulates the model under a piecewise-constant stimulus by jumping from event to event, where events are stimulus
+    changes, threshold crossings and refractory period ends. The next threshold crossing within a constant segment is
+    found analytically, so the cost scales with the number of spikes and stimulus changes rather than sim_time / dt.
+    The change times and currents of a piecewise-constant Protocol are given by its piecewise_constant(sim_time).
+
+    Args:
+        change_times (np.ndarray): Ascending times at which the stimulus changes, starting at 0   [seconds]
+        currents (np.ndarray): Stimulus current from each change time onward                     [Amperes]
+        sim_time (float): Simulation time                                                        [seconds]
+        params (LifParams): Model parameters, which must be scalars
+        dt (float): When given, the membrane voltage is also resampled at this time interval     [seconds]
+
+    Returns:
+        results (LifEventResults): The spike times, and the resampled membrane voltages when dt is given
+    """
+    assert all(np.ndim(x) == 0 for x in vars(params).values()), 'Event-driven simulation requires scalar parameters'
+    # The event loop runs on Python floats and lists, as it handles one scalar event at a time
+    change_times = np.asarray(change_times, dtype=float).tolist()
+    V_inf_segments = params.steady_state_voltage(np.asarray(currents, dtype=float)).tolist()
+    assert len(change_times) == len(V_inf_segments) and change_times[0] == 0, 'The stimulus must be defined from t=0'
+    segment_ends = change_times[1:] + [math.inf]
+    tau, V_rest, V_th, tau_ref = float(params.tau), float(params.V_rest), float(params.V_th), float(params.tau_ref)
+    # A membrane reset at or above threshold spikes again at once, so without a refractory period it would fire an
+    # infinite number of spikes at the same time
+    assert tau_ref > 0 or V_rest < V_th, 'A V_rest at or above V_th requires a positive tau_ref'
+
+    spike_times = []
+    anchors = []                    # (time, voltage, V_inf) from which the voltage decays until the next anchor
+    t, V, k = 0.0, V_rest, 0
+    while t < sim_time:
+        V_inf = V_inf_segments[k]
+        t_end = min(segment_ends[k], sim_time)
+        anchors.append((t, V, V_inf))
+
+        # Time until V(t) = V_inf + (V - V_inf) * exp(-(t' - t) / tau) reaches V_th, if it ever does
+        if V >= V_th:
+            t_cross = t
+        elif V_inf > V_th:
+            t_cross = t + tau * math.log((V - V_inf) / (V_th - V_inf))
+        else:
+            t_cross = math.inf
+
+        if t_cross < t_end:
+            # Spike, then skip the whole refractory period, during which the membrane rests at V_rest
+            spike_times.append(t_cross)
+            anchors.append((t_cross, V_rest, V_rest))
+            t, V = t_cross + tau_ref, V_rest
+            k = bisect.bisect_right(change_times, t, lo=k) - 1
+        else:
+            V = V_inf + (V - V_inf) * math.exp(-(t_end - t) / tau)
+            t, k = t_end, k + 1
+
+    spike_times = np.array(spike_times)
+    if dt is None:
+        return LifEventResults(spike_times)
+
+    # Evaluate the analytic solution from the last anchor before each sample time
+    times = np.arange(0, sim_time + dt, dt)
+    anchor_times, anchor_V, anchor_V_inf = np.array(anchors).T
+    idx = np.searchsorted(anchor_times, times, side='right') - 1
+    V_m = anchor_V_inf[idx] + (anchor_V[idx] - anchor_V_inf[idx]) * np.exp(-(times - anchor_times[idx]) / tau)
+    V_m[np.ceil(spike_times / dt - 1e-9).astype(int)] = params.V_spike
+    return LifEventResults(spike_times, times, V_m)
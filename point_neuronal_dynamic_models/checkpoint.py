@@ -0,0 +1,54 @@
+import struct
+import numpy as np
+
+from dataclasses import dataclass
+
+
+# Magic number, format version, model name length, state dimensions and time step index
+_HEADER = struct.Struct('<4sBHBq')
+_MAGIC = b'NCKP'
+_VERSION = 1
+
+
+@dataclass
+class Checkpoint:
+    """
+    Snapshot of a simulation, from which it can be resumed: the model's full state as a float64 array (the state
+    vector of an HhModel, or the v and u variables of an Izhikevich simulation), and the index of the next time step.
+    Checkpoints are stored in a compact binary format, a fixed header followed by the raw state.
+    """
+    model: str          # Name of the model class that the state belongs to
+    step: int           # Index of the next time step to simulate
+    state: np.ndarray
+
+    def __post_init__(self) -> None:
+        self.state = np.array(self.state, dtype=np.float64)
+
+    def expect(self, model: str) -> None:
+        assert self.model == model, f'Cannot resume a {model} from a {self.model} checkpoint'
+
+    def to_bytes(self) -> bytes:
+        name = self.model.encode()
+        shape = struct.pack(f'<{self.state.ndim}q', *self.state.shape)
+        header = _HEADER.pack(_MAGIC, _VERSION, len(name), self.state.ndim, self.step)
+        return header + shape + name + self.state.astype('<f8').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Checkpoint':
+        magic, version, name_length, ndim, step = _HEADER.unpack_from(data)
+        assert magic == _MAGIC and version == _VERSION, 'Not a checkpoint, or of an unsupported version'
+        offset = _HEADER.size
+        shape = struct.unpack_from(f'<{ndim}q', data, offset)
+        offset += 8 * ndim
+        model = data[offset:offset + name_length].decode()
+        state = np.frombuffer(data, dtype='<f8', count=int(np.prod(shape)), offset=offset + name_length)
+        return cls(model, step, state.reshape(shape))
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as file:
+            file.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path: str) -> 'Checkpoint':
+        with open(path, 'rb') as file:
+            return cls.from_bytes(file.read())
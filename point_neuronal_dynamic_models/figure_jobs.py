@@ -0,0 +1,148 @@
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+
+# Lines are downsampled to about this many points before drawing, twice the pixel width of a 10 inch wide figure at
+# 100 dpi, which is the most a figure can show
+MAX_POINTS = 2000
+
+
+def downsample(x: np.ndarray, y: np.ndarray, max_points: int = MAX_POINTS) -> tuple:
+    '''
+    Downsamples a line to at most max_points points, keeping the minimum and the maximum of every bucket of samples
+    (in their order of occurrence), so that spikes and other narrow extrema are still drawn
+    '''
+    x, y = np.asarray(x), np.asarray(y)
+    bucket_count = max_points // 2
+    if len(y) <= max_points or bucket_count < 1:
+        return x, y
+    bucket_size = -(-len(y) // bucket_count)
+    starts = np.arange(0, len(y), bucket_size)
+    padded = np.pad(y.astype(float), (0, len(starts) * bucket_size - len(y)), constant_values=np.nan)
+    buckets = padded.reshape(len(starts), bucket_size)
+    extrema = np.sort(np.column_stack((np.nanargmin(buckets, axis=1), np.nanargmax(buckets, axis=1))), axis=1)
+    indices = (starts[:, np.newaxis] + extrema).ravel()
+    return x[indices], y[indices]
+
+
+@dataclass
+class Line:
+    x: np.ndarray
+    y: np.ndarray
+    kwargs: dict
+
+
+@dataclass
+class FigureJob:
+    '''
+    This class describes a figure as plain data, so that it can be queued and drawn by another process. Lines are
+    cropped to xlim and downsampled when they are added, which also keeps the jobs small to send to workers.
+    '''
+    title: str
+    path: str = None    # The figure is shown interactively when no path is given
+    xlabel: str = None
+    ylabel: str = None
+    xlim: tuple = None
+    figsize: tuple = (10, 5)
+    fontsize: int = 15
+    legend_loc: int = 1
+    lines: list = field(default_factory=list)
+
+    def plot(self, x: np.ndarray, y: np.ndarray, max_points: int = MAX_POINTS, **kwargs) -> None:
+        x, y = np.asarray(x), np.asarray(y)
+        if self.xlim is not None:
+            # Keep one sample beyond either limit, so that lines still reach the edges of the axes
+            first, last = np.searchsorted(x, self.xlim[0], side='right'), np.searchsorted(x, self.xlim[1])
+            x, y = x[max(first - 1, 0):last + 1], y[max(first - 1, 0):last + 1]
+        self.lines.append(Line(*downsample(x, y, max_points), kwargs))
+
+    def draw(self, figure) -> None:
+        axes = figure.add_subplot()
+        for line in self.lines:
+            axes.plot(line.x, line.y, **line.kwargs)
+        if self.xlim is not None:
+            axes.set_xlim(self.xlim)
+        axes.set_title(self.title, fontsize=self.fontsize)
+        axes.set_xlabel(self.xlabel, fontsize=self.fontsize)
+        axes.set_ylabel(self.ylabel, fontsize=self.fontsize)
+        axes.legend(loc=self.legend_loc)
+
+
+def render(job: FigureJob) -> str:
+    '''
+    Renders a job into its file on an Agg canvas. The figure is created without pyplot, so it is never registered
+    with any backend, and is released as soon as the call returns.
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(figsize=job.figsize)
+    FigureCanvasAgg(figure)
+    job.draw(figure)
+    figure.savefig(job.path)
+    return job.path
+
+
+def show(job: FigureJob) -> None:
+    import matplotlib.pyplot as plt
+
+    figure = plt.figure(figsize=job.figsize)
+    job.draw(figure)
+    plt.show()
+    plt.close(figure)
+
+
+class FigureRenderer:
+    '''
+    This class renders figure jobs in one of three modes: 'pool' queues jobs that have a path to a pool of worker
+    processes, so that the caller returns to simulating right away, 'inline' renders them in the calling process, and
+    'none' drops every job. Jobs without a path are shown interactively in the calling process, except in 'none' mode.
+    '''
+    MODES = ('pool', 'inline', 'none')
+
+    def __init__(self, mode: str = 'pool', workers: int = None) -> None:
+        assert mode in self.MODES, f'mode must be one of {self.MODES}'
+        self.mode = mode
+        self.workers = workers
+        self._executor = None
+        self._futures = []
+
+    def __enter__(self) -> 'FigureRenderer':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def submit(self, job: FigureJob) -> None:
+        if self.mode == 'none':
+            return
+        if job.path is None:
+            show(job)
+        elif self.mode == 'inline':
+            render(job)
+        else:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            self._futures.append(self._executor.submit(render, job))
+
+    def wait(self) -> list:
+        '''
+        Waits for all queued jobs, raising the first rendering error if any, and returns the paths rendered since the
+        previous wait
+        '''
+        futures, self._futures = self._futures, []
+        return [future.result() for future in futures]
+
+    def close(self) -> None:
+        try:
+            self.wait()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+# Renders figures in the calling process, as the models always have, when no renderer is given
+INLINE = FigureRenderer('inline')
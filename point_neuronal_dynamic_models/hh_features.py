@@ -0,0 +1,163 @@
+import numpy as np
+
+from dataclasses import dataclass
+
+from HnH import HhModelResults
+
+
+@dataclass
+class FeatureTable:
+    columns: dict   # Column name -> values, all of the same length, one row per spike or per run
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values())))
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def to_npz(self, path: str) -> None:
+        np.savez(path, **self.columns)
+
+    def to_csv(self, path: str) -> None:
+        formats = ['%d' if np.issubdtype(column.dtype, np.integer) else '%.15g' for column in self.columns.values()]
+        table = np.column_stack([column.astype(float) for column in self.columns.values()])
+        np.savetxt(path, table, fmt=formats, delimiter=',', header=','.join(self.columns), comments='')
+
+
+def _gather(flat: np.ndarray, starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+    # Returns a row per [start, stop) range of the flat array, padded with NaN up to the longest range
+    offsets = np.arange(max(int((stops - starts).max(initial=0)), 1))
+    indices = starts[:, np.newaxis] + offsets
+    valid = indices < stops[:, np.newaxis]
+    return np.where(valid, flat[np.minimum(indices, len(flat) - 1)], np.nan)
+
+
+def _crossing(flat: np.ndarray, index: np.ndarray, level: np.ndarray) -> np.ndarray:
+    # Fractional sample index at which the voltage crosses the level between samples index and index + 1
+    return index + (level - flat[index]) / (flat[index + 1] - flat[index])
+
+
+def spike_features(results: HhModelResults, threshold: float = 50.0, dvdt_threshold: float = 10.0,
+                   window: float = 5.0) -> FeatureTable:
+    '''
+    Detects the spikes of every run of single or batched results, and measures each of them, with vectorized
+    operations over all runs and spikes at once. Spikes are the excursions of V_m above the detection threshold, and
+    those cut off by either end of the trace are dropped. Voltages are in the model's units, relative to rest.
+
+    Args:
+        results (HhModelResults): Results with a recorded V_m, sampled on a uniform time grid
+        threshold (float): Detection threshold of the spikes                                    [mV]
+        dvdt_threshold (float): Voltage slope at which an AP is considered to start             [mV/ms]
+        window (float): How far before its detection, and after its peak, a spike is searched   [ms]
+
+    Returns:
+        spikes (FeatureTable): One row per spike, with the run index, the threshold-crossing time, the peak time and
+                               voltage, the AP threshold voltage, the half-width, and the AHP depth below the AP
+                               threshold until the next spike
+    '''
+    assert results.V_m is not None, 'Spike detection requires a recorded V_m'
+    times = results.times
+    dt = times[1] - times[0]
+    assert dt > 0 and np.allclose(np.diff(times), dt), 'Spike detection requires a uniform time grid'
+    V = np.atleast_2d(results.V_m)
+    run_count, point_count = V.shape
+    lookaround = max(int(round(window / dt)), 1)
+
+    # Onsets are the first samples above threshold and offsets the first ones below it again, so that both come in
+    # the same row-major order, pairing up one to one
+    edges = np.diff(np.pad(V >= threshold, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    run, onset = np.nonzero(edges == 1)
+    offset = np.nonzero(edges == -1)[1]
+    complete = (onset > 0) & (offset < point_count)
+    run, onset, offset = run[complete], onset[complete], offset[complete]
+
+    # Flat indices, with a trailing sample so that ranges may end at the very end of the last run
+    flat = np.append(V.ravel(), V[-1, -1])
+    row_start = run * point_count
+    row_end = row_start + point_count
+    starts = row_start + onset
+    stops = row_start + offset
+    same_run_as_previous = np.concatenate(([False], run[1:] == run[:-1]))
+    same_run_as_next = np.concatenate((run[1:] == run[:-1], [False]))
+    previous_stop = np.where(same_run_as_previous, np.roll(stops, 1), row_start)
+    next_start = np.where(same_run_as_next, np.roll(starts, -1), row_end)
+
+    peak_index = starts + np.nanargmax(_gather(flat, starts, stops), axis=1) if len(starts) else starts
+    peak = flat[peak_index]
+
+    # The AP threshold is the first sample, within the lookaround before the detection, whose forward slope
+    # reaches dvdt_threshold
+    dvdt = np.append(np.diff(V, axis=1, append=V[:, -1:]).ravel(), 0.0) / dt
+    search_start = np.maximum(starts - lookaround, previous_stop)
+    steep = _gather(dvdt, search_start, starts) >= dvdt_threshold
+    threshold_index = np.where(steep.any(axis=1), search_start + steep.argmax(axis=1), starts)
+    threshold_voltage = flat[threshold_index]
+
+    # The half-width is measured at half the amplitude from the AP threshold to the peak, between the last sample
+    # below it before the peak and the first one below it after the peak
+    half = (threshold_voltage + peak) / 2
+    rising = _gather(flat, threshold_index, peak_index) < half[:, np.newaxis]
+    rising_index = threshold_index + rising.shape[1] - 1 - rising[:, ::-1].argmax(axis=1)
+    rising_index = np.minimum(rising_index, peak_index - 1)
+    falling_stop = np.minimum(peak_index + lookaround, next_start)
+    falling = _gather(flat, peak_index, falling_stop) < half[:, np.newaxis]
+    falling_index = peak_index + falling.argmax(axis=1) - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        half_width = (_crossing(flat, falling_index, half) - _crossing(flat, rising_index, half)) * dt
+    half_width = np.where(falling.any(axis=1) & rising.any(axis=1), half_width, np.nan)
+
+    # The AHP trough is the minimum between the end of the spike and the start of the next one, or the end of the run
+    if len(starts):
+        trough = np.minimum.reduceat(flat, np.column_stack((stops, next_start)).ravel())[::2]
+    else:
+        trough = np.empty(0)
+
+    spike_time = times[0] + (_crossing(flat, starts - 1, np.full(len(starts), float(threshold))) - row_start) * dt
+    return FeatureTable({
+        'run': run,
+        'spike_time': spike_time,
+        'peak_time': times[peak_index - row_start],
+        'peak': peak,
+        'threshold': threshold_voltage,
+        'half_width': half_width,
+        'ahp_depth': threshold_voltage - trough,
+    })
+
+
+def run_summary(results: HhModelResults, spikes: FeatureTable = None, parameters: dict = None,
+                **detection_kwargs) -> FeatureTable:
+    '''
+    Summarizes the spikes of every run of single or batched results into one row per run, with the spike count, the
+    firing rate over the whole run and from the mean ISI (both in Hz, for times in ms), and the mean of every spike
+    feature, which is NaN for runs without spikes.
+
+    Args:
+        results (HhModelResults): The summarized results
+        spikes (FeatureTable): The spike features of the results, detected with detection_kwargs when not given
+        parameters (dict): Per-run columns prepended to the summary, e.g. SweepResults.parameters
+    '''
+    spikes = spikes if spikes is not None else spike_features(results, **detection_kwargs)
+    run_count = 1 if results.V_m.ndim == 1 else results.V_m.shape[0]
+    run = spikes['run']
+    spike_count = np.bincount(run, minlength=run_count)
+    duration = results.times[-1] - results.times[0]
+
+    # ISIs only pair up consecutive spikes of the same run
+    same_run = run[1:] == run[:-1]
+    isi = np.diff(spikes['spike_time'])[same_run]
+    isi_count = np.bincount(run[1:][same_run], minlength=run_count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_isi = np.bincount(run[1:][same_run], weights=isi, minlength=run_count) / isi_count
+
+        columns = {name: np.asarray(values) for name, values in (parameters or {}).items()}
+        columns.update({
+            'run': np.arange(run_count),
+            'spike_count': spike_count,
+            'firing_rate': spike_count / duration * 1e3,
+            'isi_rate': np.where(isi_count > 0, 1e3 / mean_isi, 0.0),
+        })
+        for name in ('peak', 'threshold', 'half_width', 'ahp_depth'):
+            valid = ~np.isnan(spikes[name])
+            columns[f'mean_{name}'] = (np.bincount(run[valid], weights=spikes[name][valid], minlength=run_count)
+                                       / np.bincount(run[valid], minlength=run_count))
+    return FeatureTable(columns)
@@ -0,0 +1,135 @@
+import numpy as np
+
+
+def _diverged(stepper, delta_tms: float) -> OverflowError:
+    # The error of a fixed step whose voltage left the range of the rate functions, which only a diverging run reaches
+    return OverflowError(f'{type(stepper).__name__} diverged with delta_tms={delta_tms} ms, the membrane potential '
+                         f'left the range of the rate functions; use a smaller step or the RushLarsen stepper')
+
+
+class ForwardEuler:
+    '''
+    This stepper advances the voltage and the gates with explicit Euler steps, which is the scheme HhModel has always
+    used, and stays the default
+    '''
+    adaptive = False
+
+    def step(self, model, stimulus_current: float, delta_tms: float) -> None:
+        try:
+            model._iterate(stimulus_current, delta_tms)
+        except OverflowError as error:
+            raise _diverged(self, delta_tms) from error
+
+
+class RushLarsen:
+    '''
+    This stepper implements the Rush-Larsen (exponential Euler) scheme. Every gate is integrated exactly under the
+    rates of the step's starting voltage, and so is the voltage under the step's starting conductances, since both
+    are linear in themselves. Each variable then relaxes towards its steady state without overshooting, which keeps
+    steps stable where forward Euler diverges.
+    '''
+    adaptive = False
+
+    def step(self, model, stimulus_current: float, delta_tms: float) -> None:
+        try:
+            model._iterate_exponential(stimulus_current, delta_tms)
+        except OverflowError as error:
+            raise _diverged(self, delta_tms) from error
+
+
+class AdaptiveRK45:
+    '''
+    This integrator implements the Dormand-Prince RK5(4) pair with local error control. Steps grow during quiescent
+    periods and shrink during spikes, never cross a change of the stimulus, and may span several output samples,
+    which are then filled by cubic Hermite interpolation.
+
+    Being explicit, it gains accuracy per unit of cost rather than speed: the fast sodium activation keeps the model
+    stiff at rest, so quiescent steps stay bounded by stability near 0.7 ms, far below what the error control would
+    allow. Over 10 s without stimulus it takes about 14,000 steps, and runs barely faster than ForwardEuler at
+    delta_tms = 0.05. RushLarsen is the cheaper choice for long quiet runs.
+    '''
+    adaptive = True
+
+    # Dormand-Prince Butcher tableau
+    C = np.array([0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1])
+    A = [np.array([]),
+         np.array([1 / 5]),
+         np.array([3 / 40, 9 / 40]),
+         np.array([44 / 45, -56 / 15, 32 / 9]),
+         np.array([19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729]),
+         np.array([9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656])]
+    B = np.array([35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84])
+    E = np.array([71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40])  # 5th minus 4th order
+
+    def __init__(self, rtol: float = 1e-4, atol: float = 1e-5, first_step: float = 0.01, max_step: float = 10.0) -> None:
+        assert rtol > 0 and atol > 0 and 0 < first_step <= max_step, 'Invalid integrator configuration'
+        self.rtol = rtol
+        self.atol = atol
+        self.first_step = first_step
+        self.max_step = max_step
+        self.accepted_steps = 0
+        self.rejected_steps = 0
+
+    def _step(self, model, y: np.ndarray, f: np.ndarray, stimulus_current: float, h: float) -> tuple:
+        k = np.empty((7, len(y)))
+        k[0] = f
+        try:
+            for i in range(1, 6):
+                k[i] = model.derivatives(y + h * (self.A[i] @ k[:i]), stimulus_current)
+            y_new = y + h * (self.B @ k[:6])
+            k[6] = model.derivatives(y_new, stimulus_current)  # Reused as the next step's first stage
+        except OverflowError:
+            # A far too large trial step can drive the voltage out of the rate functions' range
+            return y, f, np.inf
+        scale = self.atol + self.rtol * np.maximum(np.abs(y), np.abs(y_new))
+        error = np.sqrt(np.mean((h * (self.E @ k) / scale) ** 2))
+        return y_new, k[6], error
+
+    @staticmethod
+    def _interpolate(t: float, h: float, y0: np.ndarray, f0: np.ndarray, y1: np.ndarray, f1: np.ndarray,
+                     t_out: np.ndarray) -> np.ndarray:
+        s = ((t_out - t) / h)[:, np.newaxis]
+        return ((1 + 2 * s) * (1 - s) ** 2 * y0 + s * (1 - s) ** 2 * h * f0
+                + s ** 2 * (3 - 2 * s) * y1 + s ** 2 * (s - 1) * h * f1)
+
+    def integrate(self, model, stimuli: np.ndarray, delta_tms: float) -> np.ndarray:
+        '''
+        Integrates the model through the piecewise-constant stimuli, where stimuli[i] drives the interval
+        [i * delta_tms, (i + 1) * delta_tms), and returns the model states at the end of every interval, as rows of
+        an array of shape (len(stimuli), 4). The model is left at the final state.
+        '''
+        point_count = len(stimuli)
+        sample_times = (np.arange(point_count) + 1) * delta_tms
+        states = np.empty((point_count, 4))
+        segment_starts = np.concatenate(([0], np.flatnonzero(np.diff(stimuli)) + 1))
+        segment_ends = np.append(segment_starts[1:], point_count)
+
+        y = model.get_state()
+        t, h, k = 0.0, self.first_step, 0
+        for start, end in zip(segment_starts, segment_ends):
+            stimulus_current = stimuli[start]
+            t_end = end * delta_tms
+            f = model.derivatives(y, stimulus_current)
+            while t < t_end:
+                h = min(h, self.max_step)
+                last = h >= t_end - t
+                if last:
+                    h = t_end - t
+                y_new, f_new, error = self._step(model, y, f, stimulus_current, h)
+
+                if error <= 1:
+                    self.accepted_steps += 1
+                    t_new = t_end if last else t + h
+                    count = np.searchsorted(sample_times, t_new + 1e-9 * delta_tms, side='right') - k
+                    if count > 0:
+                        states[k:k + count] = self._interpolate(t, h, y, f, y_new, f_new, sample_times[k:k + count])
+                        k += count
+                    t, y, f = t_new, y_new, f_new
+                else:
+                    self.rejected_steps += 1
+
+                # Standard step size controller for a 5th order method, with growth and shrink limits
+                h *= min(5.0, max(0.2, 0.9 * error ** -0.2)) if 0 < error < np.inf else (5.0 if error == 0 else 0.2)
+
+        model.set_state(y)
+        return states
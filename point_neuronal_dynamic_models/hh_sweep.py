@@ -0,0 +1,138 @@
+import os
+import sys
+import itertools
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+
+from HnH import TRACE_NAMES, HhModelResults, HhPopulation
+from figure_jobs import FigureRenderer
+
+
+def parameter_grid(**axes) -> list:
+    '''
+    Returns the Cartesian product of the given parameter values, as a list of HhModel keyword-argument dictionaries
+    '''
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+
+@dataclass
+class SweepResults:
+    parameters: dict    # Parameter name -> values, of shape (n_points,)
+    times: np.ndarray
+    stimuli: np.ndarray
+    traces: dict        # Trace name -> values, of shape (n_points, point_count), for the recorded traces only
+
+    def __len__(self) -> int:
+        return len(next(iter(self.parameters.values())))
+
+    def index(self, **parameters) -> int:
+        '''
+        Returns the index of the sweep point with the given parameter values
+        '''
+        mask = np.logical_and.reduce([np.isclose(self.parameters[name], value) for name, value in parameters.items()])
+        assert mask.sum() == 1, f'{mask.sum()} sweep points match {parameters}'
+        return int(np.flatnonzero(mask)[0])
+
+    def cell(self, index: int) -> HhModelResults:
+        '''
+        Returns the results of a single sweep point, with the traces that were not recorded set to None
+        '''
+        return HhModelResults(self.times, self.stimuli, **{name: values[index] for name, values in self.traces.items()})
+
+    def save(self, path: str) -> None:
+        columns = {f'parameter.{name}': values for name, values in self.parameters.items()}
+        columns.update({f'trace.{name}': values for name, values in self.traces.items()})
+        np.savez(path, times=self.times, stimuli=self.stimuli, **columns)
+
+    @classmethod
+    def load(cls, path: str) -> 'SweepResults':
+        with np.load(path) as data:
+            parameters = {key.split('.', 1)[1]: data[key] for key in data.files if key.startswith('parameter.')}
+            traces = {key.split('.', 1)[1]: data[key] for key in data.files if key.startswith('trace.')}
+            return cls(parameters, data['times'], data['stimuli'], traces)
+
+
+def _simulate_chunk(indices: np.ndarray, parameters: list, point_count: int, record: tuple) -> tuple:
+    # Runs in a worker process, where the chunk is simulated as one vectorized population
+    results = HhPopulation.from_parameters(parameters).simulate(point_count, record=record)
+    return indices, results.times, results.stimuli, {name: getattr(results, name) for name in record}
+
+
+def iter_sweep(grid: list, point_count: int = 5000, record: tuple = TRACE_NAMES, workers: int = None,
+               chunk_size: int = 64):
+    '''
+    Simulates every point of the grid, split into chunks that are distributed over a process pool, and yields
+    (indices, times, stimuli, traces) for each chunk as soon as it completes, in completion order.
+    '''
+    chunks = [np.arange(start, min(start + chunk_size, len(grid))) for start in range(0, len(grid), chunk_size)]
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        for indices in chunks:
+            yield _simulate_chunk(indices, [grid[i] for i in indices], point_count, record)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_simulate_chunk, indices, [grid[i] for i in indices], point_count, record)
+                   for indices in chunks]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def run_sweep(grid: list, point_count: int = 5000, record: tuple = TRACE_NAMES, workers: int = None,
+              chunk_size: int = 64, output: str = None) -> SweepResults:
+    '''
+    Runs a parameter sweep and gathers it into columnar results, keyed by the swept parameters, which are saved to
+    the output path when one is given. Nothing is plotted; see SweepResults.cell for plotting single points.
+
+    Args:
+        grid (list): HhModel keyword-argument dictionaries, one per sweep point, e.g. from parameter_grid
+        point_count (int): Number of simulated samples per point
+        record (tuple): Names of the traces to keep
+        workers (int): Number of worker processes, defaults to the number of CPUs
+        chunk_size (int): Number of points simulated together by a worker
+        output (str): Path of an NPZ file to save the results into
+    '''
+    assert grid, 'Empty parameter grid'
+    assert set(record) <= set(TRACE_NAMES), f'Recorded traces must be among {TRACE_NAMES}'
+    names = sorted(set().union(*grid))
+    parameters = {name: np.array([point.get(name, np.nan) for point in grid], dtype=float) for name in names}
+    traces = {name: np.empty((len(grid), point_count)) for name in record}
+
+    times = stimuli = None
+    for indices, times, stimuli, chunk_traces in iter_sweep(grid, point_count, record, workers, chunk_size):
+        for name, values in chunk_traces.items():
+            traces[name][indices] = values
+
+    results = SweepResults(parameters, times, stimuli, traces)
+    if output:
+        results.save(output)
+    return results
+
+
+def main():
+    plot = len(sys.argv) > 1 and sys.argv[1] == '--plot'
+
+    # The E_Na, E_K and E_leak sweeps of HnH.main, each around the standard values of the other two
+    sweeps = {
+        'E_Na': parameter_grid(E_Na=range(50, 200, 5), E_K=[-12], E_leak=[10.6]),
+        'E_K': parameter_grid(E_Na=[115], E_K=range(0, 100, 2), E_leak=[10.6]),
+        'E_leak': parameter_grid(E_Na=[115], E_K=[-12], E_leak=range(-30, 30, 2)),
+    }
+
+    for swept, grid in sweeps.items():
+        results = run_sweep(grid, record=('V_m', 'I_Na', 'I_K', 'I_leak', 'I_sum'), output=f'hh_sweep_{swept}.npz')
+        print(f'Swept {swept} over {len(grid)} points into hh_sweep_{swept}.npz')
+
+        # Plotting is an optional post-processing step over the stored results, saved by a worker pool
+        if plot:
+            with FigureRenderer('pool') as renderer:
+                for i in range(len(grid)):
+                    results.cell(i).plot(membrane_potential=True, ion_currents=True, to_file=True,
+                                         identifier=f'{swept}={results.parameters[swept][i]:g}', renderer=renderer)
+
+
+if __name__ == '__main__':
+    main()
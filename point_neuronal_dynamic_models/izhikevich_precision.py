@@ -0,0 +1,320 @@
+import time
+import importlib
+import numpy as np
+
+from dataclasses import dataclass
+
+from stimulus_protocols import Step
+
+# The module name is not a valid identifier, hence the import by name
+izhikevich = importlib.import_module('Izhikevich-HW')
+IzhikevichModel = izhikevich.IzhikevichModel
+IzhikevichParamsArray = izhikevich.IzhikevichParamsArray
+
+
+PRECISIONS = ('float64', 'float32', 'fixed')
+
+
+@dataclass(frozen=True)
+class QFormat:
+    """
+    Signed fixed-point format Qm.n, with m integer bits and n fraction bits besides the sign bit, in which the raw
+    integer q stands for q / 2^n. Raw values are stored in the smallest integer type that holds the word, and
+    saturate at the bounds of the word rather than wrapping around.
+    """
+    integer_bits: int
+    fraction_bits: int
+
+    def __post_init__(self) -> None:
+        assert self.integer_bits >= 0 and self.fraction_bits >= 0, 'Bit counts cannot be negative'
+        # Products of two words are accumulated in 64 bits
+        assert self.word_bits <= 32, 'Words are at most 32 bits wide'
+
+    def __str__(self) -> str:
+        return f'Q{self.integer_bits}.{self.fraction_bits}'
+
+    @property
+    def word_bits(self) -> int:
+        return 1 + self.integer_bits + self.fraction_bits
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(next(f'int{bits}' for bits in (8, 16, 32) if self.word_bits <= bits))
+
+    @property
+    def scale(self) -> int:
+        return 1 << self.fraction_bits
+
+    @property
+    def bounds(self) -> tuple:
+        return -(1 << (self.word_bits - 1)), (1 << (self.word_bits - 1)) - 1
+
+    def saturate(self, q: np.ndarray) -> np.ndarray:
+        return np.clip(q, *self.bounds)
+
+    def quantize(self, x: np.ndarray) -> np.ndarray:
+        return self.saturate(np.round(np.asarray(x, dtype=float) * self.scale)).astype(self.dtype)
+
+    def dequantize(self, q: np.ndarray) -> np.ndarray:
+        return np.asarray(q, dtype=float) / self.scale
+
+
+@dataclass(frozen=True)
+class FixedPointFormats:
+    """
+    Formats of the fixed-point mode: v, u and I are stored as 16-bit words by default, in mV and the stimulus units,
+    with more fraction bits for u, whose range is narrower. The a * dt and b coefficients, and the constants of the v
+    equation, take 32-bit words, as they are much smaller than one.
+    """
+    v: QFormat = QFormat(7, 8)
+    u: QFormat = QFormat(5, 10)
+    I: QFormat = QFormat(7, 8)
+    coefficients: QFormat = QFormat(7, 24)
+
+    def __str__(self) -> str:
+        return f'v {self.v}, u {self.u}, I {self.I}, coefficients {self.coefficients}'
+
+
+def _shift(q: np.ndarray, bits: int) -> np.ndarray:
+    # Arithmetic shift by the given number of bits to the right, rounding to the nearest like a fixed-point multiplier
+    # does before truncating its product, or to the left for negative bit counts
+    if bits > 0:
+        return (q + (1 << (bits - 1))) >> bits
+    return q << -bits
+
+
+def _convert(q: np.ndarray, source: QFormat, target: QFormat) -> np.ndarray:
+    return _shift(q, source.fraction_bits - target.fraction_bits)
+
+
+class PrecisionModel:
+    """
+    Emulates an IzhikevichModel in reduced precision, for neuromorphic hardware that stores the state of its cells in
+    float32 or in 16-bit fixed point. Populations are stepped with vectorized operations like simulate_batch, and
+    their traces are kept in the storage type of the precision, which is a half of float64 for float32 and a quarter
+    for 16-bit fixed point. In fixed point, every operation is done on the raw integers, accumulated in 64 bits and
+    rounded back into the format of the result, and v and u saturate at the bounds of their formats.
+    The stabilization is simulated in the same precision as the experiment, since stabilized float64 states from the
+    rest cache would not be the states that the hardware settles to.
+    """
+
+    def __init__(self, model: IzhikevichModel, precision: str = 'float32', formats: FixedPointFormats = None) -> None:
+        """
+        Initializes the emulation.
+
+        Args:
+            model (IzhikevichModel): Model whose times, time step and spike apex are emulated
+            precision (str): One of PRECISIONS
+            formats (FixedPointFormats): Formats of the fixed-point precision, 16-bit words by default
+        """
+        assert precision in PRECISIONS, f'precision must be one of {PRECISIONS}'
+        self.model = model
+        self.precision = precision
+        self.formats = formats or FixedPointFormats()
+
+    @property
+    def dtype(self) -> np.dtype:
+        """
+        The storage type of the traces.
+        """
+        if self.precision == 'fixed':
+            return np.promote_types(self.formats.v.dtype, self.formats.u.dtype)
+        return np.dtype(self.precision)
+
+    @property
+    def v_apex(self):
+        """
+        The spike apex in the storage type, which the v traces hold at every spike.
+        """
+        if self.precision == 'fixed':
+            return self.formats.v.quantize(self.model.v_spike_apex)
+        return self.dtype.type(self.model.v_spike_apex)
+
+    def simulate_batch(self, params: IzhikevichParamsArray, stimuli: np.ndarray, v0s: np.ndarray = None) -> np.ndarray:
+        """
+        Simulates a population of independent cells over the model's times in the emulated precision.
+
+        Args:
+            params (IzhikevichParamsArray): a, b, c, and d parameters of every cell
+            stimuli (np.ndarray): Stimulus current intensities, either shared (N,) or per cell (n_cells, N), where
+                                  protocols may stand for any of the stimuli
+            v0s (np.ndarray): Membrane resting potential of every cell, a scalar or (n_cells,). Defaults to model.v_0
+
+        Returns:
+            traces (np.ndarray): Tracing du and dv of every cell in the storage type, of shape (n_cells, 2, N), which
+                                 to_float converts to mV
+        """
+        n_cells = len(params)
+        stimuli = self.model._sample_batch(stimuli, n_cells)
+        v0s = np.broadcast_to(np.asarray(self.model.v_0 if v0s is None else v0s, dtype=float), (n_cells,))
+
+        # Stimuli and traces are time-major, as in simulate_batch, and stored in the emulated precision
+        traces = np.zeros((len(self.model.times), 2, n_cells), dtype=self.dtype)
+        if self.precision == 'fixed':
+            self._step_fixed(params, v0s, np.ascontiguousarray(self.formats.I.quantize(stimuli).T), traces)
+        else:
+            a, b, c, d = (x.astype(self.dtype) for x in params.as_tuple())
+            v = v0s.astype(self.dtype)
+            stimuli = np.ascontiguousarray(stimuli.T, dtype=self.dtype)
+            self.model._step_batch(a, b, c, d, v, b * v, stimuli, 0, len(stimuli), traces)
+        return np.ascontiguousarray(traces.transpose(2, 1, 0))
+
+    def _step_fixed(self, params: IzhikevichParamsArray, v0s: np.ndarray, stimuli: np.ndarray,
+                    traces: np.ndarray) -> None:
+        v_format, u_format, I_format, coefficient_format = (
+            self.formats.v, self.formats.u, self.formats.I, self.formats.coefficients)
+        coefficient_bits = coefficient_format.fraction_bits
+        dt = self.model.dt
+
+        # The coefficients are quantized once, and the time step is folded into a, as the hardware would
+        a_dt = coefficient_format.quantize(params.a * dt).astype(np.int64)
+        b = coefficient_format.quantize(params.b).astype(np.int64)
+        c = v_format.quantize(params.c).astype(np.int64)
+        d = u_format.quantize(params.d).astype(np.int64)
+        square = int(coefficient_format.quantize(0.04))
+        step = int(coefficient_format.quantize(dt))
+        # 140 mV exceeds the range of 16-bit v formats, so it is only ever added to the 64-bit accumulator
+        rest = int(round(140 * v_format.scale))
+        v_apex = int(self.v_apex)
+
+        v = v_format.quantize(v0s).astype(np.int64)
+        u = u_format.saturate(_shift(b * _convert(v, v_format, u_format), coefficient_bits))
+        for i in range(len(stimuli)):
+            I = _convert(stimuli[i].astype(np.int64), I_format, v_format)
+
+            # dv/dt = 0.04 v^2 + 5 v + 140 - u + I, accumulated in the format of v
+            # v^2 is rounded into the format of v before it is scaled, so that 32-bit formats do not overflow
+            dv = (_shift(square * _shift(v * v, v_format.fraction_bits), coefficient_bits) + 5 * v + rest
+                  - _convert(u, u_format, v_format) + I)
+            v = v_format.saturate(v + _shift(step * dv, coefficient_bits))
+
+            # du/dt = a (b v - u), accumulated in the format of u
+            bv = _shift(b * _convert(v, v_format, u_format), coefficient_bits)
+            u = u_format.saturate(u + _shift(a_dt * (bv - u), coefficient_bits))
+
+            spiked = v > v_apex
+            traces[i, 0] = np.where(spiked, v_apex, v)
+            traces[i, 1] = np.where(spiked, 0, u)
+            v = np.where(spiked, c, v)
+            u = np.where(spiked, u_format.saturate(u + d), u)
+
+    def to_float(self, traces: np.ndarray) -> np.ndarray:
+        """
+        Converts traces in the storage type to float64 traces in mV.
+        """
+        if self.precision != 'fixed':
+            return traces.astype(float)
+        return np.stack((self.formats.v.dequantize(traces[:, 0]), self.formats.u.dequantize(traces[:, 1])), axis=1)
+
+
+@dataclass
+class PrecisionReport:
+    """
+    Errors of an emulated precision against the float64 reference, per cell, over the experiment after the
+    stabilization.
+    """
+    precision: str
+    formats: str
+    seconds: float              # Simulation time of the emulation
+    bytes_per_sample: int       # Storage size of one trace sample
+    rms_v: np.ndarray           # Root mean square error of v                                    [mV]
+    max_v: np.ndarray           # Maximal absolute error of v                                    [mV]
+    rms_u: np.ndarray           # Root mean square error of u
+    spikes: np.ndarray          # Spike count in the emulated precision
+    reference_spikes: np.ndarray
+    spike_shift: np.ndarray     # Mean absolute shift of the k-th spikes of both trains, NaN without common spikes [ms]
+    divergence: np.ndarray      # Time at which v first deviates beyond the tolerance, NaN if it never does [ms]
+
+    def __len__(self) -> int:
+        return len(self.rms_v)
+
+    def summary(self) -> str:
+        diverged = np.count_nonzero(~np.isnan(self.divergence))
+        with np.errstate(invalid='ignore'):
+            shift = np.nanmean(self.spike_shift) if np.any(~np.isnan(self.spike_shift)) else np.nan
+        return (f'{self.precision:>8} ({self.formats}): {self.seconds:.2f} s, {self.bytes_per_sample} B/sample, '
+                f'rms v {self.rms_v.mean():.4g} mV (max {self.max_v.max():.4g}), rms u {self.rms_u.mean():.4g}, '
+                f'spikes {self.spikes.sum()}/{self.reference_spikes.sum()}, mean shift {shift:.4g} ms, '
+                f'diverged {diverged}/{len(self)}')
+
+
+def _spike_shift(reference: np.ndarray, spikes: np.ndarray, dt: float) -> np.ndarray:
+    # Pairs the k-th spike of either train of every cell by a (cell, rank) key, with vectorized operations over all
+    # spikes at once, and averages the absolute shift of the pairs per cell
+    n_cells, point_count = reference.shape
+
+    def events(mask: np.ndarray) -> tuple:
+        cell, index = np.nonzero(mask)
+        rank = np.arange(len(cell)) - np.searchsorted(cell, cell)
+        return cell * point_count + rank, index
+
+    reference_key, reference_index = events(reference)
+    key, index = events(spikes)
+    _, reference_at, at = np.intersect1d(reference_key, key, assume_unique=True, return_indices=True)
+    cell = reference_key[reference_at] // point_count
+    shift = np.abs(index[at] - reference_index[reference_at]) * dt
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.bincount(cell, weights=shift, minlength=n_cells) / np.bincount(cell, minlength=n_cells)
+
+
+def error_report(model: IzhikevichModel, params: IzhikevichParamsArray, stimuli: np.ndarray, v0s: np.ndarray = None,
+                 precisions: tuple = PRECISIONS, formats: FixedPointFormats = None, tolerance: float = 1.0) -> list:
+    """
+    Simulates a population in each of the given precisions, and compares every one of them to the float64
+    reference of model.simulate_batch.
+
+    Args:
+        model (IzhikevichModel): The emulated model
+        params (IzhikevichParamsArray): a, b, c, and d parameters of every cell
+        stimuli (np.ndarray): Shared or per-cell stimuli, as taken by simulate_batch
+        v0s (np.ndarray): Membrane resting potential of every cell, defaults to model.v_0
+        precisions (tuple): The compared precisions
+        formats (FixedPointFormats): Formats of the fixed-point precision
+        tolerance (float): Deviation of v from which a cell has diverged from the reference          [mV]
+
+    Returns:
+        reports (list): A PrecisionReport per precision
+    """
+    start = model.start_idx
+    reference = model.simulate_batch(params, stimuli, v0s)[..., start:]
+    reference_spikes = reference[:, 0] == model.v_spike_apex
+
+    reports = []
+    for precision in precisions:
+        emulation = PrecisionModel(model, precision, formats)
+        started = time.perf_counter()
+        traces = emulation.simulate_batch(params, stimuli, v0s)
+        seconds = time.perf_counter() - started
+        spikes = traces[:, 0, start:] == emulation.v_apex
+        error = emulation.to_float(traces[..., start:]) - reference
+
+        deviated = np.abs(error[:, 0]) > tolerance
+        divergence = np.where(deviated.any(axis=1), model.times[start + deviated.argmax(axis=1)], np.nan)
+        reports.append(PrecisionReport(
+            precision=precision,
+            formats=str(emulation.formats) if precision == 'fixed' else precision,
+            seconds=seconds,
+            bytes_per_sample=traces.itemsize,
+            rms_v=np.sqrt(np.mean(error[:, 0] ** 2, axis=1)),
+            max_v=np.abs(error[:, 0]).max(axis=1),
+            rms_u=np.sqrt(np.mean(error[:, 1] ** 2, axis=1)),
+            spikes=np.count_nonzero(spikes, axis=1),
+            reference_spikes=np.count_nonzero(reference_spikes, axis=1),
+            spike_shift=_spike_shift(reference_spikes, spikes, model.dt),
+            divergence=divergence,
+        ))
+    return reports
+
+
+def main():
+    # A population from regular spiking to chattering cells, drawn as in Izhikevich's (2003) network model
+    rng = np.random.default_rng(0)
+    r = rng.random(1000)
+    params = IzhikevichParamsArray(a=0.02, b=0.2, c=-65 + 15 * r * r, d=8 - 6 * r * r)
+    model = IzhikevichModel(T=1000, dt=0.1)
+    for report in error_report(model, params, Step(0, amplitude=10)):
+        print(report.summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+import sys
+import importlib
+import numpy as np
+
+from dataclasses import dataclass
+
+from figure_jobs import INLINE, FigureJob
+from stimulus_protocols import Step
+
+# The module name is not a valid identifier, hence the import by name
+izhikevich = importlib.import_module('Izhikevich-HW')
+IzhikevichParamsArray = izhikevich.IzhikevichParamsArray
+
+
+REGIMES = ('quiescent', 'phasic', 'RS', 'FS', 'LTS', 'IB', 'CH')
+PARAMETER_NAMES = ('a', 'b', 'c', 'd')
+
+
+def fixed_points(b: np.ndarray, I: np.ndarray) -> tuple:
+    """
+    Returns the membrane potentials of the two fixed points, where the v-nullcline u = 0.04 v^2 + 5 v + 140 + I meets
+    the u-nullcline u = b v, and whether they exist. Both are NaN where the nullclines do not intersect, in which case
+    the cell cannot rest, and spikes tonically.
+    """
+    discriminant = (5 - b) ** 2 - 0.16 * (140 + I)
+    exists = discriminant >= 0
+    root = np.sqrt(np.where(exists, discriminant, np.nan))
+    return (b - 5 - root) / 0.08, (b - 5 + root) / 0.08, exists
+
+
+def nullclines(v: np.ndarray, b: float, I: float) -> tuple:
+    """
+    Returns the u values of the v-nullcline and the u-nullcline over the given membrane potentials.
+    """
+    return 0.04 * v * v + 5 * v + 140 + I, b * v
+
+
+def is_stable(a: np.ndarray, b: np.ndarray, v: np.ndarray) -> np.ndarray:
+    """
+    Returns whether the fixed point at v is stable, from the trace and the determinant of the Jacobian
+    [[0.08 v + 5, -1], [a b, -a]].
+    """
+    slope = 0.08 * v + 5
+    return (slope - a < 0) & (a * (b - slope) > 0)
+
+
+def obviously_quiescent(params: IzhikevichParamsArray, I: float, v: np.ndarray, u: np.ndarray,
+                        margin: float = 0.5) -> np.ndarray:
+    """
+    Returns which cells stay at rest under the constant current I from the state (v, u), without simulating them:
+    those whose lower fixed point is stable, and whose state lies within the given fraction of the distance from
+    that fixed point to the saddle, which bounds its basin of attraction along the u-nullcline.
+    """
+    a, b, _, _ = params.as_tuple()
+    v_rest, v_saddle, exists = fixed_points(b, I)
+    with np.errstate(invalid='ignore'):
+        distance = np.hypot(v - v_rest, u - b * v_rest)
+        basin = margin * np.hypot(v_saddle - v_rest, b * (v_saddle - v_rest))
+        return exists & is_stable(a, b, v_rest) & (distance <= basin)
+
+
+@dataclass
+class RegimeMap:
+    parameters: np.ndarray  # a, b, c and d of every point, of shape (n_points, 4)
+    labels: np.ndarray      # Index into REGIMES of every point
+    features: dict          # Feature name -> values, of shape (n_points,)
+    simulated: np.ndarray   # Whether the point was simulated, rather than found quiescent analytically
+    level: np.ndarray       # Refinement level at which the point was added, 0 for the initial grid
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    @property
+    def regimes(self) -> np.ndarray:
+        return np.array(REGIMES)[self.labels]
+
+    def counts(self) -> dict:
+        return dict(zip(REGIMES, np.bincount(self.labels, minlength=len(REGIMES)).tolist()))
+
+    def save(self, path: str) -> None:
+        np.savez(path, parameters=self.parameters, labels=self.labels, simulated=self.simulated, level=self.level,
+                 **{f'feature.{name}': values for name, values in self.features.items()})
+
+    @classmethod
+    def load(cls, path: str) -> 'RegimeMap':
+        with np.load(path) as data:
+            features = {key.split('.', 1)[1]: data[key] for key in data.files if key.startswith('feature.')}
+            return cls(data['parameters'], data['labels'], features, data['simulated'], data['level'])
+
+
+class RegimeClassifier:
+    """
+    Classifies the firing pattern of Izhikevich cells under a step current, from the ISI and burst statistics of
+    their spike trains. Cells are simulated in chunks with the vectorized batch kernel, after skipping the cells that
+    their phase plane shows to stay at rest. The resonator and thalamo-cortical dynamics only show under pulses and
+    hyperpolarizing steps, so a step classifies them as fast spiking.
+    """
+
+    def __init__(self, T: float = 1000, dt: float = 0.1, amplitude: float = 10, onset: float = 10, v_0: float = -70,
+                 burst_ratio: float = 8, chunk_size: int = 256, rest_cache=None) -> None:
+        """
+        Initializes the classifier.
+
+        Args:
+            T (float): Simulated time after the stabilization                                  [milliseconds]
+            dt (float): Simulation time interval                                                [milliseconds]
+            amplitude (float): Amplitude of the step current
+            onset (float): Onset time of the step                                               [milliseconds]
+            v_0 (float): Membrane resting potential                                            [mV]
+            burst_ratio (float): Longest to shortest ISI ratio from which a spike train is bursting
+            chunk_size (int): Number of cells simulated together
+            rest_cache (RestStateCache): Cache of stabilized states, a private one by default
+        """
+        assert 0 <= onset < T and burst_ratio > 1 and chunk_size >= 1, 'Invalid classifier configuration'
+        self.model = izhikevich.IzhikevichModel(T, dt, v_0, rest_cache=rest_cache or izhikevich.RestStateCache())
+        self.amplitude = amplitude
+        self.onset = onset
+        self.stimulus = Step(onset, amplitude=amplitude)
+        self.burst_ratio = burst_ratio
+        self.chunk_size = chunk_size
+
+    def spike_events(self, traces: np.ndarray) -> tuple:
+        """
+        Returns the cell index and the time since the step onset of every spike in the traces, in cell order.
+        """
+        onset_idx = self.model.start_idx + int(round(self.onset / self.model.dt))
+        cell, idx = np.nonzero(traces[:, 0, onset_idx:] == self.model.v_spike_apex)
+        return cell, idx * self.model.dt
+
+    def spike_features(self, cell: np.ndarray, times: np.ndarray, n_cells: int) -> dict:
+        """
+        Computes the spike train statistics of every cell from its spike events, with vectorized operations over all
+        spikes at once.
+        """
+        duration = self.model.times[-1] - self.onset
+        count = np.bincount(cell, minlength=n_cells)
+        has_spikes = count > 0
+        has_isis = count > 1
+
+        # Spike times padded with NaN, which cells without the indexed spikes pick
+        padded = np.append(times, np.nan)
+        first = np.searchsorted(cell, np.arange(n_cells))
+        last = np.searchsorted(cell, np.arange(n_cells), side='right') - 1
+        first_time = np.where(has_spikes, padded[first], np.nan)
+        last_time = np.where(has_spikes, padded[last], np.nan)
+        first_isi = np.where(has_isis, padded[np.minimum(first + 1, len(times))] - first_time, np.nan)
+        last_isi = np.where(has_isis, last_time - padded[last - 1], np.nan)
+
+        # ISIs pair up consecutive spikes of the same cell, and are kept in spike order
+        same_cell = cell[1:] == cell[:-1]
+        isi = np.diff(times)[same_cell]
+        isi_cell = cell[1:][same_cell]
+        position = np.arange(len(isi))
+        min_isi = np.full(n_cells, np.inf)
+        max_isi = np.zeros(n_cells)
+        np.minimum.at(min_isi, isi_cell, isi)
+        np.maximum.at(max_isi, isi_cell, isi)
+
+        # Short ISIs, below the geometric mean of the extremes, join spikes into bursts. Bursting cells whose short
+        # ISIs all precede their first long one fire a single initial burst
+        with np.errstate(divide='ignore', invalid='ignore'):
+            isi_ratio = np.where(has_isis, max_isi / min_isi, np.nan)
+            bursting = has_isis & (isi_ratio > self.burst_ratio)
+            short = isi < np.sqrt(min_isi * max_isi)[isi_cell]
+            steady_rate = 1e3 / last_isi
+        last_short = np.full(n_cells, -1)
+        first_long = np.full(n_cells, len(isi))
+        np.maximum.at(last_short, isi_cell[short], position[short])
+        np.minimum.at(first_long, isi_cell[~short], position[~short])
+
+        return {
+            'spike_count': count,
+            'latency': first_time,
+            'rate': count / duration * 1e3,
+            'steady_rate': steady_rate,
+            'adaptation': last_isi / first_isi,
+            'isi_ratio': isi_ratio,
+            'last_spike': last_time,
+            'bursting': bursting,
+            'initial_burst': bursting & (last_short < first_long),
+        }
+
+    def label(self, features: dict, phasic_fraction: float = 0.2, regular_rate: float = 40,
+              low_threshold_adaptation: float = 3) -> np.ndarray:
+        """
+        Labels every cell with its index into REGIMES: quiescent without spikes, phasic when it only spikes shortly
+        after the onset, IB or CH when bursting once or repeatedly, and otherwise tonic, as RS below regular_rate
+        (in Hz), LTS when strongly adapting, or FS.
+        """
+        duration = self.model.times[-1] - self.onset
+        count = features['spike_count']
+        labels = np.full(len(count), REGIMES.index('FS'))
+        with np.errstate(invalid='ignore'):
+            labels[features['adaptation'] > low_threshold_adaptation] = REGIMES.index('LTS')
+            labels[features['steady_rate'] < regular_rate] = REGIMES.index('RS')
+            labels[features['bursting']] = REGIMES.index('CH')
+            labels[features['initial_burst']] = REGIMES.index('IB')
+            labels[(count > 0) & ((count <= 2) | (features['last_spike'] < phasic_fraction * duration))] = \
+                REGIMES.index('phasic')
+        labels[count == 0] = REGIMES.index('quiescent')
+        return labels
+
+    def classify(self, params: IzhikevichParamsArray) -> tuple:
+        """
+        Classifies every cell, and returns their labels, features, and whether they were simulated.
+        """
+        n_cells = len(params)
+        rest = self.model.rest_states(params, self.model.v_0, 0.0)
+        simulated = ~obviously_quiescent(params, self.amplitude, *rest)
+
+        # Spike events are gathered over the chunks, with cell indices into params
+        cells, times = [np.empty(0, dtype=int)], [np.empty(0)]
+        for start in range(0, n_cells, self.chunk_size):
+            chunk = np.arange(start, min(start + self.chunk_size, n_cells))
+            chunk = chunk[simulated[chunk]]
+            if len(chunk):
+                chunk_params = IzhikevichParamsArray(*(x[chunk] for x in params.as_tuple()))
+                cell, spike_times = self.spike_events(self.model.simulate_batch(chunk_params, self.stimulus))
+                cells.append(chunk[cell])
+                times.append(spike_times)
+
+        features = self.spike_features(np.concatenate(cells), np.concatenate(times), n_cells)
+        return self.label(features), features, simulated
+
+    def map(self, max_level: int = 3, **axes) -> RegimeMap:
+        """
+        Maps the regimes over the Cartesian grid of the given a, b, c and d values, then refines it near the
+        boundaries: every grid edge whose end points differ in regime is bisected, for up to max_level levels, so
+        that the remaining compute goes to locating the boundaries.
+        """
+        assert set(axes) == set(PARAMETER_NAMES), f'Values are required for each of {PARAMETER_NAMES}'
+        axes = [np.atleast_1d(np.asarray(axes[name], dtype=float)) for name in PARAMETER_NAMES]
+        params = IzhikevichParamsArray.from_grid(*axes)
+        points = np.column_stack(params.as_tuple())
+        labels, features, simulated = self.classify(params)
+        level = np.zeros(len(points), dtype=int)
+
+        # Edges join the neighbouring grid points along every axis
+        index = np.arange(len(points)).reshape([len(axis) for axis in axes])
+        edges = np.concatenate([np.column_stack((np.delete(index, -1, axis).ravel(), np.delete(index, 0, axis).ravel()))
+                                for axis in range(len(axes))])
+
+        for refinement in range(1, max_level + 1):
+            edges = edges[labels[edges[:, 0]] != labels[edges[:, 1]]]
+            if len(edges) == 0:
+                break
+            midpoints = (points[edges[:, 0]] + points[edges[:, 1]]) / 2
+            new_labels, new_features, new_simulated = self.classify(IzhikevichParamsArray(*midpoints.T))
+            new_index = np.arange(len(points), len(points) + len(midpoints))
+
+            points = np.concatenate((points, midpoints))
+            labels = np.concatenate((labels, new_labels))
+            simulated = np.concatenate((simulated, new_simulated))
+            level = np.concatenate((level, np.full(len(midpoints), refinement)))
+            features = {name: np.concatenate((values, new_features[name])) for name, values in features.items()}
+            edges = np.concatenate((np.column_stack((edges[:, 0], new_index)), np.column_stack((new_index, edges[:, 1]))))
+
+        return RegimeMap(points, labels, features, simulated, level)
+
+
+def main():
+    savefig = len(sys.argv) > 1 and sys.argv[1] == '--savefig'
+
+    # The (c, d) plane of the cortical cells, at the a and b of the regular spiking cell
+    classifier = RegimeClassifier()
+    regime_map = classifier.map(a=[0.02], b=[0.2], c=np.linspace(-70, -45, 11), d=np.linspace(0.5, 10, 11))
+    regime_map.save('izhikevich_regimes.npz')
+    print(f'{len(regime_map)} points, of which {regime_map.simulated.sum()} simulated: {regime_map.counts()}')
+
+    job = FigureJob('Izhikevich Regimes (a=0.02, b=0.2)', 'izhikevich_regimes.png' if savefig else None,
+                    xlabel='c (mV)', ylabel='d')
+    for label, regime in enumerate(REGIMES):
+        points = regime_map.parameters[regime_map.labels == label]
+        if len(points):
+            job.plot(points[:, 2], points[:, 3], max_points=len(points), linestyle='', marker='o', label=regime)
+    INLINE.submit(job)
+
+
+if __name__ == '__main__':
+    main()
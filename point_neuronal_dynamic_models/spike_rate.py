@@ -0,0 +1,103 @@
+import math
+import numpy as np
+
+
+class SpikeRateEstimator:
+    """
+    Streaming spike rate estimator with O(1) updates, keeping the most recent spike times in a preallocated ring
+    buffer. Rates are given in the inverse of the time unit used for the spike times.
+    """
+
+    def __init__(self, capacity: int = 256, window: float = 1.0, smoothing_tau: float = 0.1) -> None:
+        """
+        Initializes the estimator.
+
+        Args:
+            capacity (int): Number of most recent spikes kept, which bounds the ISIs used for the CV and the spikes
+                            counted within the window
+            window (float): Duration of the sliding window of the windowed mean rate
+            smoothing_tau (float): Time constant of the exponentially smoothed rate
+        """
+        assert capacity >= 2 and window > 0 and smoothing_tau > 0, 'Invalid estimator configuration'
+        self.capacity = capacity
+        self.window = window
+        self.smoothing_tau = smoothing_tau
+        self.reset()
+
+    def reset(self) -> None:
+        self._spike_times = np.empty(self.capacity)
+        self._head = 0                  # Ring buffer index of the next spike
+        self._count = 0                 # Number of buffered spikes
+        self._window_start = 0          # Number of buffered spikes that fell out of the window, counted from the oldest
+        self._isi_sum = 0.0             # Sum and sum of squares of the ISIs between buffered spikes
+        self._isi_sum_sq = 0.0
+        self._smoothed_at_last_spike = 0.0
+        self.last_spike_time = None
+        self.last_isi = None
+        self.spike_count = 0            # Total number of spikes seen since the last reset
+
+    def _buffered(self, age: int) -> float:
+        """
+        Returns the buffered spike time, where age 0 is the most recent spike.
+        """
+        return self._spike_times[(self._head - 1 - age) % self.capacity]
+
+    def add_spike(self, t: float) -> None:
+        if self.last_spike_time is not None:
+            isi = t - self.last_spike_time
+            self.last_isi = isi
+            self._isi_sum += isi
+            self._isi_sum_sq += isi * isi
+
+            # Evicting the oldest spike also evicts the oldest ISI
+            if self._count == self.capacity:
+                evicted_isi = self._buffered(self._count - 2) - self._buffered(self._count - 1)
+                self._isi_sum -= evicted_isi
+                self._isi_sum_sq -= evicted_isi * evicted_isi
+                self._window_start = max(self._window_start - 1, 0)
+
+            # Exponential kernel rate, sum(exp(-(t - t_k) / tau)) / tau, decayed lazily between spikes
+            self._smoothed_at_last_spike *= math.exp(-isi / self.smoothing_tau)
+        self._smoothed_at_last_spike += 1 / self.smoothing_tau
+
+        self._spike_times[self._head] = t
+        self._head = (self._head + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+        self.last_spike_time = t
+        self.spike_count += 1
+
+    def update(self, t: float, spiked: bool) -> None:
+        """
+        Per-step entry point for simulators, which records a spike at time t if one occurred.
+        """
+        if spiked:
+            self.add_spike(t)
+
+    @property
+    def last_isi_rate(self) -> float:
+        return 1 / self.last_isi if self.last_isi else 0.0
+
+    def windowed_rate(self, t: float) -> float:
+        """
+        Returns the mean rate over the window that ends at time t, which must not precede earlier queries.
+        """
+        while self._window_start < self._count and self._buffered(self._count - 1 - self._window_start) <= t - self.window:
+            self._window_start += 1
+        return (self._count - self._window_start) / self.window
+
+    def smoothed_rate(self, t: float) -> float:
+        if self.last_spike_time is None:
+            return 0.0
+        return self._smoothed_at_last_spike * math.exp(-(t - self.last_spike_time) / self.smoothing_tau)
+
+    @property
+    def cv_isi(self) -> float:
+        """
+        Returns the coefficient of variation of the ISIs between the buffered spikes.
+        """
+        n = self._count - 1
+        if n < 2:
+            return 0.0
+        mean = self._isi_sum / n
+        variance = max(self._isi_sum_sq / n - mean * mean, 0.0)
+        return math.sqrt(variance) / mean
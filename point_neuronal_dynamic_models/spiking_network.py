@@ -0,0 +1,344 @@
+import sys
+import time
+import importlib
+import numpy as np
+
+from dataclasses import dataclass
+
+from LIF_model import LifParams
+from figure_jobs import INLINE, FigureJob
+from stimulus_protocols import BLOCK_SIZE, Protocol
+
+# The module name is not a valid identifier, hence the import by name
+izhikevich = importlib.import_module('Izhikevich-HW')
+IzhikevichParamsArray = izhikevich.IzhikevichParamsArray
+
+
+@dataclass
+class Connectivity:
+    """
+    Synapses of a network in compressed sparse row (CSR) form, with a row per presynaptic cell, so that the synapses
+    of a spiking cell are the contiguous range indptr[cell]:indptr[cell + 1] of the synapse arrays. Memory scales with
+    the number of synapses, and delivering spikes only reads the rows of the cells that spiked.
+    """
+    n_cells: int
+    indptr: np.ndarray      # Offset of the first synapse of every presynaptic cell, of shape (n_cells + 1,)
+    targets: np.ndarray     # Postsynaptic cell of every synapse
+    weights: np.ndarray     # Current injected by every synapse into its target, in the units of the population input
+    delays: np.ndarray      # Transmission delay of every synapse, in time steps, at least one
+
+    def __post_init__(self) -> None:
+        assert len(self.indptr) == self.n_cells + 1 and self.indptr[-1] == len(self.targets), 'Invalid CSR layout'
+        assert len(self.targets) == len(self.weights) == len(self.delays), 'Synapse arrays must be of equal lengths'
+        assert len(self.delays) == 0 or self.delays.min() >= 1, 'Delays must last at least one time step'
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    @property
+    def max_delay(self) -> int:
+        return int(self.delays.max(initial=1))
+
+    @property
+    def nbytes(self) -> int:
+        return sum(x.nbytes for x in (self.indptr, self.targets, self.weights, self.delays))
+
+    @classmethod
+    def from_edges(cls, n_cells: int, sources: np.ndarray, targets: np.ndarray, weights: np.ndarray,
+                   delays: np.ndarray = 1) -> 'Connectivity':
+        """
+        Creates the connectivity from a list of synapses, in any order, where weights and delays may be scalars.
+        """
+        sources, targets = np.asarray(sources, dtype=int), np.asarray(targets, dtype=int)
+        weights, delays = np.broadcast_arrays(np.asarray(weights, dtype=float), np.asarray(delays), sources)[:2]
+        assert len(sources) == 0 or (min(sources.min(), targets.min()) >= 0 and
+                                     max(sources.max(), targets.max()) < n_cells), 'Cells out of range'
+        order = np.argsort(sources, kind='stable')
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(sources, minlength=n_cells))))
+        return cls(n_cells, indptr, targets[order].astype(np.int32), weights[order],
+                   delays[order].astype(np.int16))
+
+    @classmethod
+    def random(cls, n_cells: int, out_degree: int, weights: np.ndarray, delays: np.ndarray = 1,
+               seed: int = 0) -> 'Connectivity':
+        """
+        Creates a network in which every cell projects to out_degree distinct random other cells, where weights and
+        delays may be scalars or given per presynaptic cell.
+
+        Args:
+            n_cells (int): Number of cells
+            out_degree (int): Number of synapses of every presynaptic cell
+            weights (np.ndarray): Synaptic weight, a scalar or per presynaptic cell (n_cells,)
+            delays (np.ndarray): Delay in time steps, a scalar, per presynaptic cell (n_cells,), or a (low, high)
+                                 tuple, from which every synapse draws a delay uniformly, both included
+            seed (int): Seed of the random generator
+        """
+        assert 0 <= out_degree < n_cells, 'A cell cannot project to more than all the other cells'
+        rng = np.random.default_rng(seed)
+        # Targets are drawn among the n_cells - 1 other cells, without replacement
+        targets = _distinct_targets(rng, n_cells, out_degree)
+        sources = np.repeat(np.arange(n_cells), out_degree)
+        targets = targets.ravel()
+        targets += targets >= sources   # Skips the presynaptic cell itself
+        if isinstance(delays, tuple):
+            delays = rng.integers(delays[0], delays[1] + 1, size=len(sources))
+        else:
+            delays = np.broadcast_to(delays, (n_cells,))[sources]
+        return cls.from_edges(n_cells, sources, targets, np.broadcast_to(weights, (n_cells,))[sources], delays)
+
+
+def _distinct_targets(rng: np.random.Generator, n_cells: int, out_degree: int) -> np.ndarray:
+    # Draws out_degree distinct cells among n_cells - 1 for every cell, by redrawing duplicates, so that memory stays
+    # proportional to the number of synapses. Redraws collide more often as the draws get denser, so beyond a quarter
+    # of the cells every row is a random permutation instead, whose int32 temporary is at most twice the targets
+    if 4 * out_degree > n_cells - 1:
+        others = np.broadcast_to(np.arange(n_cells - 1, dtype=np.int32), (n_cells, n_cells - 1))
+        return rng.permuted(others, axis=1)[:, :out_degree].astype(np.intp)
+    targets = rng.integers(n_cells - 1, size=(n_cells, out_degree))
+    rows = np.arange(n_cells)   # Rows that may still hold duplicates
+    while len(rows):
+        ordered = np.sort(targets[rows], axis=1)
+        duplicated = np.zeros(ordered.shape, dtype=bool)
+        duplicated[:, 1:] = ordered[:, 1:] == ordered[:, :-1]
+        ordered[duplicated] = rng.integers(n_cells - 1, size=np.count_nonzero(duplicated))
+        targets[rows] = ordered
+        rows = rows[duplicated.any(axis=1)]
+    return targets
+
+
+class IzhikevichPopulation:
+    """
+    Izhikevich cells, stepped together with the equations of IzhikevichModel.simulate_batch, from their parameters
+    in the IzhikevichParamsArray layout. Times are in milliseconds.
+    """
+
+    def __init__(self, params: IzhikevichParamsArray, dt: float, v_0: np.ndarray = -70, v_apex: float = 30) -> None:
+        self.params = params
+        self.dt = dt
+        self.v_apex = v_apex
+        self.spike_potential = v_apex
+        self.v = np.broadcast_to(np.asarray(v_0, dtype=float), (len(params),)).copy()
+        self.u = params.b * self.v
+
+    def __len__(self) -> int:
+        return len(self.params)
+
+    @property
+    def potential(self) -> np.ndarray:
+        return self.v
+
+    def step(self, I: np.ndarray) -> np.ndarray:
+        """
+        Advances every cell by one time step under the input currents I, and returns which cells spiked.
+        """
+        a, b, c, d = self.params.as_tuple()
+        v, u = self.v, self.u
+        v += self.dt * (0.04 * (v * v) + 5 * v + 140 - u + I)
+        u += self.dt * a * (b * v - u)
+        spiked = v > self.v_apex
+        v[spiked] = c[spiked]
+        u[spiked] += d[spiked]
+        return spiked
+
+
+class LifPopulation:
+    """
+    Leaky integrate-and-fire cells, stepped together with the exact exponential integration of LIF_model.simulate.
+    Times are in seconds, and the inputs are currents in Amperes.
+    """
+
+    def __init__(self, n_cells: int, dt: float, params: LifParams = None) -> None:
+        self.params = params = params or LifParams()
+        self.dt = dt
+        self.spike_potential = params.V_spike
+        self.decay = np.broadcast_to(np.exp(-dt / params.tau), (n_cells,))
+        self.refractory_steps = np.broadcast_to(np.round(np.asarray(params.tau_ref) / dt).astype(int), (n_cells,))
+        self.V_rest = np.broadcast_to(np.asarray(params.V_rest, dtype=float), (n_cells,))
+        self.V = self.V_rest.copy()
+        self.refractory = np.zeros(n_cells, dtype=int)     # Remaining refractory steps
+
+    def __len__(self) -> int:
+        return len(self.V)
+
+    @property
+    def potential(self) -> np.ndarray:
+        return self.V
+
+    def step(self, I: np.ndarray) -> np.ndarray:
+        """
+        Advances every cell by one time step under the input currents I, and returns which cells spiked.
+        """
+        V_inf = self.params.steady_state_voltage(I)
+        active = self.refractory == 0
+        self.V = np.where(active, V_inf + (self.V - V_inf) * self.decay, self.V)
+        self.refractory = np.maximum(self.refractory - 1, 0)
+
+        # Threshold crossings emit a spike, reset to V_rest and start a refractory period
+        spiked = active & (self.V >= self.params.V_th)
+        self.V = np.where(spiked, self.V_rest, self.V)
+        self.refractory = np.where(spiked, self.refractory_steps, self.refractory)
+        return spiked
+
+
+@dataclass
+class NetworkResults:
+    dt: float
+    n_cells: int
+    spike_steps: np.ndarray     # Time step index of every spike, in ascending order
+    spike_cells: np.ndarray     # Cell of every spike
+    recorded: np.ndarray        # Recorded cells
+    traces: np.ndarray          # Potential of every recorded cell, of shape (len(recorded), point_count)
+    point_count: int
+
+    @property
+    def times(self) -> np.ndarray:
+        return np.arange(self.point_count) * self.dt
+
+    @property
+    def spike_times(self) -> np.ndarray:
+        return self.spike_steps * self.dt
+
+    def rates(self) -> np.ndarray:
+        """
+        Returns the mean firing rate of every cell, in spikes per unit of time.
+        """
+        return np.bincount(self.spike_cells, minlength=self.n_cells) / (self.point_count * self.dt)
+
+
+class SpikingNetwork:
+    """
+    Simulates a population of point cells connected by delayed current synapses. The spikes of every step are
+    delivered by reading the CSR rows of the spiking cells only, which is the sparse product of the connectivity with
+    the sparse spike vector, into a circular buffer holding the synaptic input of the next max_delay steps, so that
+    delivery costs time proportional to the synapses of the cells that spiked. A spike at step i reaches its targets
+    as an input current during step i + delay.
+    """
+
+    def __init__(self, population, connectivity: Connectivity) -> None:
+        """
+        Initializes the network.
+
+        Args:
+            population: An IzhikevichPopulation or a LifPopulation, or any population with a step(I) method that
+                        returns which cells spiked
+            connectivity (Connectivity): Synapses between the cells of the population
+        """
+        assert len(population) == connectivity.n_cells, 'The connectivity does not match the population'
+        self.population = population
+        self.connectivity = connectivity
+        self.dt = population.dt
+        self.step_index = 0
+        # One slot per pending step, and one for the current step, which is read and cleared before delivering
+        self.buffer = np.zeros((connectivity.max_delay + 1, len(population)))
+
+    def deliver(self, spiking: np.ndarray) -> None:
+        """
+        Schedules the synaptic input of the given spiking cells at the current step.
+        """
+        indptr = self.connectivity.indptr
+        starts = indptr[spiking]
+        counts = indptr[spiking + 1] - starts
+        # The concatenated synapse ranges of all spiking cells, without a Python loop over the cells
+        synapses = np.arange(counts.sum()) + np.repeat(starts - np.cumsum(counts) + counts, counts)
+        slots = (self.step_index + self.connectivity.delays[synapses]) % len(self.buffer)
+        np.add.at(self.buffer, (slots, self.connectivity.targets[synapses]), self.connectivity.weights[synapses])
+
+    def step(self, I: np.ndarray = 0.0) -> np.ndarray:
+        """
+        Advances the network by one time step under the external currents I, and returns the spiking cells.
+        """
+        slot = self.step_index % len(self.buffer)
+        synaptic = self.buffer[slot].copy()
+        self.buffer[slot] = 0
+        spiking = np.flatnonzero(self.population.step(synaptic + I))
+        self.deliver(spiking)
+        self.step_index += 1
+        return spiking
+
+    def simulate(self, point_count: int, stimulus=None, noise_std: np.ndarray = 0.0, seed: int = 0,
+                 record: np.ndarray = ()) -> NetworkResults:
+        """
+        Simulates the network for point_count steps, continuing from its current state.
+
+        Args:
+            point_count (int): Number of simulated time steps
+            stimulus: External current shared by all cells, as a Protocol of time, or an array of shape (point_count,)
+                      or (n_cells, point_count)
+            noise_std (np.ndarray): Standard deviation of a Gaussian current drawn every step, a scalar or per cell
+            seed (int): Seed of the noise
+            record (np.ndarray): Cells whose potentials are traced, spikes being traced at the spike potential
+
+        Returns:
+            results (NetworkResults): Every spike, and the traces of the recorded cells
+        """
+        n_cells = len(self.population)
+        rng = np.random.default_rng(seed)
+        noise_std = np.asarray(noise_std, dtype=float)
+        record = np.asarray(record, dtype=int)
+        traces = np.empty((len(record), point_count))
+        spike_steps, spike_cells = [], []
+        first_step = self.step_index
+
+        for start, block in self._stimulus_blocks(stimulus, point_count):
+            for offset, I in enumerate(block):
+                if noise_std.any():
+                    I = I + noise_std * rng.standard_normal(n_cells)
+                spiking = self.step(I)
+                spike_steps.append(np.full(len(spiking), self.step_index - 1 - first_step))
+                spike_cells.append(spiking)
+                if len(record):
+                    traces[:, start + offset] = np.where(np.isin(record, spiking), self.population.spike_potential,
+                                                         self.population.potential[record])
+
+        return NetworkResults(self.dt, n_cells, np.concatenate(spike_steps), np.concatenate(spike_cells), record,
+                              traces, point_count)
+
+    def _stimulus_blocks(self, stimulus, point_count: int):
+        # Yields (start, block) pairs, where block holds the external current of each step, a scalar or per cell, in
+        # blocks of bounded size for protocols
+        if stimulus is None:
+            yield 0, np.zeros(point_count)
+        elif isinstance(stimulus, Protocol):
+            yield from stimulus.blocks(point_count, self.dt, BLOCK_SIZE, offset=self.step_index)
+        else:
+            stimulus = np.asarray(stimulus, dtype=float)
+            assert stimulus.shape[-1] == point_count, 'The stimulus must cover every step'
+            yield 0, stimulus.T
+
+
+def main():
+    savefig = len(sys.argv) > 1 and sys.argv[1] == '--savefig'
+
+    # A sparse version of Izhikevich's (2003) network: excitatory cells from regular spiking to chattering, and
+    # inhibitory cells from fast spiking to low-threshold spiking, driven by thalamic noise
+    n_excitatory, n_inhibitory = 80000, 20000
+    n_cells = n_excitatory + n_inhibitory
+    rng = np.random.default_rng(0)
+    r_e, r_i = rng.random(n_excitatory), rng.random(n_inhibitory)
+    params = IzhikevichParamsArray(
+        a=np.concatenate((np.full(n_excitatory, 0.02), 0.02 + 0.08 * r_i)),
+        b=np.concatenate((np.full(n_excitatory, 0.2), 0.25 - 0.05 * r_i)),
+        c=np.concatenate((-65 + 15 * r_e * r_e, np.full(n_inhibitory, -65))),
+        d=np.concatenate((8 - 6 * r_e * r_e, np.full(n_inhibitory, 2))))
+    weights = np.concatenate((0.5 * rng.random(n_excitatory), -1.0 * rng.random(n_inhibitory))) * 8
+    delays = np.concatenate((rng.integers(2, 41, n_excitatory), np.full(n_inhibitory, 2)))   # 1 to 20 ms
+    connectivity = Connectivity.random(n_cells, 100, weights, delays)
+    noise_std = np.concatenate((np.full(n_excitatory, 5.0), np.full(n_inhibitory, 2.0)))
+
+    network = SpikingNetwork(IzhikevichPopulation(params, dt=0.5), connectivity)
+    started = time.perf_counter()
+    results = network.simulate(2000, noise_std=noise_std)
+    print(f'{n_cells} cells, {len(connectivity)} synapses ({connectivity.nbytes / 2 ** 20:.0f} MiB): '
+          f'{len(results.spike_cells)} spikes in {time.perf_counter() - started:.1f} s, '
+          f'mean rate {results.rates().mean() * 1e3:.1f} Hz')
+
+    job = FigureJob('Sparse Izhikevich Network', 'izhikevich_network.png' if savefig else None,
+                    xlabel='Time (msec)', ylabel='Cell')
+    shown = results.spike_cells < 1000
+    job.plot(results.spike_times[shown], results.spike_cells[shown], max_points=np.count_nonzero(shown),
+             linestyle='', marker='.', markersize=2, color='black', label='Spikes')
+    INLINE.submit(job)
+
+
+if __name__ == '__main__':
+    main()
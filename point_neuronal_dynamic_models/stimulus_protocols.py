@@ -0,0 +1,266 @@
+import math
+import numpy as np
+
+
+# Tolerance on time comparisons, so that protocol edges falling on grid times are not missed due to rounding
+TIME_TOLERANCE = 1e-9
+
+# Default number of samples evaluated at once by Protocol.blocks
+BLOCK_SIZE = 4096
+
+
+def _window(t: np.ndarray, start: float, stop: float) -> np.ndarray:
+    return (t >= start - TIME_TOLERANCE) & (t < stop - TIME_TOLERANCE)
+
+
+class Protocol:
+    """
+    Base class of stimulus protocols. A protocol is a function of time, evaluated lazily for any array of times at
+    once, so simulators can evaluate it per step or per block instead of storing a full-length stimulus array.
+    Protocols are composed with + and -, and scaled by numbers with *. Times and amplitudes are in the units of the
+    simulator that evaluates them.
+    """
+
+    def __call__(self, t) -> np.ndarray:
+        return self.evaluate(np.asarray(t, dtype=float))
+
+    def evaluate(self, t: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def breakpoints(self, t_end: float):
+        """
+        Returns the times before t_end at which the protocol changes value, or None if it is not piecewise constant.
+        """
+        return None
+
+    def block(self, start: int, count: int, dt: float, t_0: float = 0.0) -> np.ndarray:
+        """
+        Evaluates the protocol over count samples of the time grid t_0 + i * dt, from the sample index start onward.
+        """
+        return self(t_0 + np.arange(start, start + count) * dt)
+
+    def blocks(self, point_count: int, dt: float, block_size: int = BLOCK_SIZE, t_0: float = 0.0, offset: int = 0):
+        """
+        Yields (start, values) for consecutive blocks of at most block_size samples, covering point_count samples
+        from the sample index offset onward, where start is counted from the offset.
+        """
+        assert block_size >= 1, 'Invalid block size'
+        for start in range(0, point_count, block_size):
+            yield start, self.block(offset + start, min(block_size, point_count - start), dt, t_0)
+
+    def sample(self, point_count: int, dt: float, t_0: float = 0.0) -> np.ndarray:
+        """
+        Returns the protocol densely sampled over point_count samples, for simulators that need the whole array.
+        """
+        return self.block(0, point_count, dt, t_0)
+
+    def piecewise_constant(self, t_end: float) -> tuple:
+        """
+        Returns the times at which the protocol changes, starting at 0, and its value from each change onward, as
+        expected by LIF_model.simulate_event_driven. Only piecewise-constant protocols are supported.
+        """
+        breakpoints = self.breakpoints(t_end)
+        assert breakpoints is not None, f'{type(self).__name__} is not piecewise constant'
+        change_times = np.unique(np.concatenate(([0.0], [t for t in breakpoints if 0 < t < t_end])))
+        return change_times, self(change_times)
+
+    def __add__(self, other) -> 'Protocol':
+        if isinstance(other, (int, float)):
+            other = Constant(other)
+        return Sum(self, other) if isinstance(other, Protocol) else NotImplemented
+
+    __radd__ = __add__
+
+    def __neg__(self) -> 'Protocol':
+        return Scaled(self, -1.0)
+
+    def __sub__(self, other) -> 'Protocol':
+        return self + (-other)
+
+    def __rsub__(self, other) -> 'Protocol':
+        return (-self) + other
+
+    def __mul__(self, factor) -> 'Protocol':
+        return Scaled(self, factor) if isinstance(factor, (int, float)) else NotImplemented
+
+    __rmul__ = __mul__
+
+
+class Constant(Protocol):
+    def __init__(self, amplitude: float) -> None:
+        self.amplitude = amplitude
+
+    def evaluate(self, t: np.ndarray) -> np.ndarray:
+        return np.full(t.shape, float(self.amplitude))
+
+    def breakpoints(self, t_end: float) -> list:
+        return []
+
+
+class Step(Protocol):
+    """
+    Constant amplitude within [start, stop), and zero elsewhere.
+    """
+
+    def __init__(self, start: float, stop: float = math.inf, amplitude: float = 1.0) -> None:
+        assert start <= stop, 'A step cannot stop before it starts'
+        self.start = start
+        self.stop = stop
+        self.amplitude = amplitude
+
+    def evaluate(self, t: np.ndarray) -> np.ndarray:
+        return np.where(_window(t, self.start, self.stop), float(self.amplitude), 0.0)
+
+    def breakpoints(self, t_end: float) -> list:
+        return [t for t in (self.start, self.stop) if t < t_end]
+
+
+class PulseTrain(Protocol):
+    """
+    Rectangular pulses of the given width, every period from start onward, either indefinitely or for count pulses.
+    """
+
+    def __init__(self, start: float, width: float, period: float, amplitude: float = 1.0, count: int = None) -> None:
+        assert 0 < width <= period, 'Pulses must be narrower than their period'
+        self.start = start
+        self.width = width
+        self.period = period
+        self.amplitude = amplitude
+        self.count = count
+
+    def evaluate(self, t: np.ndarray) -> np.ndarray:
+        elapsed = t - self.start + TIME_TOLERANCE
+        index = np.floor(elapsed / self.period)
+        active = (elapsed >= 0) & (elapsed - index * self.period < self.width)
+        if self.count is not None:
+            active &= index < self.count
+        return np.where(active, float(self.amplitude), 0.0)
+
+    def breakpoints(self, t_end: float) -> list:
+        count = math.ceil(max(t_end - self.start, 0) / self.period)
+        if self.count is not None:
+            count = min(count, self.count)
+        onsets = self.start + np.arange(count) * self.period
+        return [t for t in np.column_stack((onsets, onsets + self.width)).ravel().tolist() if t < t_end]
+
+
+class Ramp(Protocol):
+    """
+    Linear ramp from start_amplitude at start to end_amplitude at stop, and zero outside [start, stop).
+    """
+
+    def __init__(self, start: float, stop: float, end_amplitude: float, start_amplitude: float = 0.0) -> None:
+        assert start < stop, 'A ramp must stop after it starts'
+        self.start = start
+        self.stop = stop
+        self.start_amplitude = start_amplitude
+        self.end_amplitude = end_amplitude
+
+    def evaluate(self, t: np.ndarray) -> np.ndarray:
+        fraction = (t - self.start) / (self.stop - self.start)
+        values = self.start_amplitude + fraction * (self.end_amplitude - self.start_amplitude)
+        return np.where(_window(t, self.start, self.stop), values, 0.0)
+
+
+class Sinusoid(Protocol):
+    """
+    offset + amplitude * sin(2 * pi * frequency * (t - start) + phase) within [start, stop), and zero elsewhere.
+    The frequency is in the inverse of the time unit, e.g. kHz for times in milliseconds.
+    """
+
+    def __init__(self, amplitude: float, frequency: float, phase: float = 0.0, offset: float = 0.0,
+                 start: float = -math.inf, stop: float = math.inf) -> None:
+        self.amplitude = amplitude
+        self.frequency = frequency
+        self.phase = phase
+        self.offset = offset
+        self.start = start
+        self.stop = stop
+
+    def evaluate(self, t: np.ndarray) -> np.ndarray:
+        origin = self.start if math.isfinite(self.start) else 0.0
+        values = self.offset + self.amplitude * np.sin(2 * np.pi * self.frequency * (t - origin) + self.phase)
+        return np.where(_window(t, self.start, self.stop), values, 0.0)
+
+
+class Noise(Protocol):
+    """
+    Gaussian noise of the given mean and standard deviation, held for every interval of the given resolution within
+    [start, stop), and zero elsewhere. Samples are drawn lazily in chunks, each from a generator seeded by the seed
+    and the chunk index, so times can be evaluated in any order and always yield the same values.
+    """
+    CHUNK_SIZE = 4096
+
+    def __init__(self, std: float, resolution: float, mean: float = 0.0, seed: int = 0, start: float = -math.inf,
+                 stop: float = math.inf) -> None:
+        assert std >= 0 and resolution > 0, 'Invalid noise configuration'
+        self.std = std
+        self.resolution = resolution
+        self.mean = mean
+        self.seed = seed
+        self.start = start
+        self.stop = stop
+        self._chunks = {}
+
+    def _chunk(self, index: int) -> np.ndarray:
+        if index not in self._chunks:
+            if len(self._chunks) >= 16:
+                self._chunks.clear()
+            # Zigzag encoding maps negative chunk indices, before t=0, to distinct non-negative seed entries
+            key = 2 * index if index >= 0 else -2 * index - 1
+            self._chunks[index] = np.random.default_rng([self.seed, key]).standard_normal(self.CHUNK_SIZE)
+        return self._chunks[index]
+
+    def evaluate(self, t: np.ndarray) -> np.ndarray:
+        active = _window(t, self.start, self.stop)
+        sample_index = np.floor(np.where(active, t, 0.0) / self.resolution + TIME_TOLERANCE).astype(np.int64)
+        chunk_index = sample_index // self.CHUNK_SIZE
+        values = np.empty(t.shape)
+        for index in np.unique(chunk_index).tolist():
+            in_chunk = chunk_index == index
+            values[in_chunk] = self._chunk(index)[sample_index[in_chunk] - index * self.CHUNK_SIZE]
+        return np.where(active, self.mean + self.std * values, 0.0)
+
+
+class Piecewise(Protocol):
+    """
+    Piecewise-constant protocol, taking values[k] from times[k] until times[k + 1], and zero before times[0].
+    """
+
+    def __init__(self, times: np.ndarray, values: np.ndarray) -> None:
+        self.times = np.asarray(times, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+        assert self.times.shape == self.values.shape and np.all(np.diff(self.times) > 0), \
+            'times must be ascending and match values'
+
+    def evaluate(self, t: np.ndarray) -> np.ndarray:
+        index = np.searchsorted(self.times, t + TIME_TOLERANCE, side='right') - 1
+        return np.where(index >= 0, self.values[np.maximum(index, 0)], 0.0)
+
+    def breakpoints(self, t_end: float) -> list:
+        return self.times[self.times < t_end].tolist()
+
+
+class Sum(Protocol):
+    def __init__(self, *terms: Protocol) -> None:
+        # Nested sums are flattened, so that long compositions evaluate in a single pass
+        self.terms = [part for term in terms for part in (term.terms if isinstance(term, Sum) else [term])]
+
+    def evaluate(self, t: np.ndarray) -> np.ndarray:
+        return sum(term.evaluate(t) for term in self.terms)
+
+    def breakpoints(self, t_end: float):
+        breakpoints = [term.breakpoints(t_end) for term in self.terms]
+        return None if any(b is None for b in breakpoints) else sorted(set().union(*breakpoints))
+
+
+class Scaled(Protocol):
+    def __init__(self, protocol: Protocol, factor: float) -> None:
+        self.protocol = protocol
+        self.factor = factor
+
+    def evaluate(self, t: np.ndarray) -> np.ndarray:
+        return self.factor * self.protocol.evaluate(t)
+
+    def breakpoints(self, t_end: float):
+        return self.protocol.breakpoints(t_end)
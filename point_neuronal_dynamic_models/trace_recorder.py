@@ -0,0 +1,58 @@
+import numpy as np
+
+
+class TraceRecorder:
+    """
+    Records per-step simulation diagnostics into preallocated NumPy columns, instead of formatting and printing them
+    at every step. The recorded rows can be dumped on demand to a CSV or an NPZ file.
+    """
+
+    def __init__(self, columns: dict, n_steps: int, stride: int = 1) -> None:
+        """
+        Initializes the recorder.
+
+        Args:
+            columns (dict): Column names mapped to their dtypes, in the order that values are passed to record
+            n_steps (int): Total number of simulation steps
+            stride (int): Only every stride-th step is recorded
+        """
+        assert columns and n_steps >= 0 and stride >= 1, 'Invalid recorder configuration'
+        self.stride = stride
+        self._columns = {name: np.zeros((n_steps + stride - 1) // stride, dtype=dtype) for name, dtype in columns.items()}
+        self._buffers = tuple(self._columns.values())
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self._columns[name][:self._size]
+
+    @property
+    def columns(self) -> tuple:
+        return tuple(self._columns)
+
+    @property
+    def data(self) -> dict:
+        return {name: column[:self._size] for name, column in self._columns.items()}
+
+    def record(self, step: int, *values) -> None:
+        """
+        Records the values of a step, given in column order, if the step falls on the sampling stride.
+        """
+        if step % self.stride:
+            return
+        row = self._size
+        for buffer, value in zip(self._buffers, values):
+            buffer[row] = value
+        self._size = row + 1
+
+    def to_npz(self, path: str) -> None:
+        np.savez_compressed(path, **self.data)
+
+    def to_csv(self, path: str) -> None:
+        data = self.data
+        formats = ['%d' if np.issubdtype(column.dtype, np.integer) or column.dtype == bool else '%.15g'
+                   for column in data.values()]
+        table = np.column_stack([column.astype(float) for column in data.values()])
+        np.savetxt(path, table, fmt=formats, delimiter=',', header=','.join(data), comments='')